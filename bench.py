@@ -0,0 +1,513 @@
+"""
+Benchmarks for the template engine.
+
+The suite generates synthetic templates, varying their size, the nesting depth of if and for statements,
+the number of elements looped over and the depth of template inheritance. For each of them it times
+tokenize, parse, eval_ and Template.render separately, and records latency percentiles, throughput and
+peak memory as JSON:
+    python bench.py run --output new.json
+
+To detect regressions, run it on another checkout, and compare:
+    python bench.py run --checkout ../old-checkout --output old.json
+    python bench.py compare old.json new.json
+
+Benchmarks focused on one optimization:
+    python bench.py parse-scaling
+    python bench.py render-many
+    python bench.py loop-invariant
+    python bench.py stream-file
+    python bench.py columnar
+    python bench.py render-bytes
+    python bench.py render-parallel
+    python bench.py warmup
+"""
+
+import os
+import gc
+import sys
+import json
+import math
+import time
+import shutil
+import timeit
+import argparse
+import subprocess
+import multiprocessing
+import platform
+import tempfile
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, peak memory is not measured
+    tracemalloc = None
+
+# The template module benchmarked, see load_engine
+engine = None
+
+
+def load_engine(checkout=None):
+    """ Import the template module, from the given checkout directory if any. """
+    global engine
+    if checkout is not None:
+        sys.path.insert(0, os.path.abspath(checkout))
+    import template
+    engine = template
+    return engine
+
+
+def make_template(sections, depth=3):
+    """ Generate a template made of sections of nested if and for statements.
+
+    >>> make_template(1, depth=1)
+    'Hello {{ name }}, {% if age >= 18 %}{% for friend in friends %}{{ friend }}, {% endfor %}{% else %}no one{% endif %}!\\n'
+    """
+    section = "{% for friend in friends %}{{ friend }}, {% endfor %}"
+    for _ in range(depth):
+        section = "{%% if age >= 18 %%}%s{%% else %%}no one{%% endif %%}" % section
+    return ("Hello {{ name }}, %s!\n" % section) * sections
+
+
+def make_data_model(elements=3):
+    return {"name": "Eva", "age": 23, "greeting": "Hello ", "friends": ["Billy %d" % index for index in range(elements)]}
+
+
+def make_inheritance_chain(directory, depth):
+    """ Write templates each extending the previous one and filling its block, return the name of the last one.
+
+    >>> directory = tempfile.mkdtemp()
+    >>> make_inheritance_chain(directory, 2)
+    'level2.tmpl'
+    >>> print(open(os.path.join(directory, 'level2.tmpl')).read())
+    {% extends level1.tmpl %}{% block level2 %}Level 2 for {{ name }}. {% block level3 %}{% endblock %}{% endblock %}
+    >>> shutil.rmtree(directory)
+    """
+    with open(os.path.join(directory, "level0.tmpl"), "w") as file_:
+        file_.write("Base for {{ name }}. {% block level1 %}{% endblock %}")
+    for level in range(1, depth + 1):
+        with open(os.path.join(directory, "level%d.tmpl" % level), "w") as file_:
+            file_.write("{%% extends level%d.tmpl %%}{%% block level%d %%}Level %d for {{ name }}. {%% block level%d %%}{%% endblock %%}{%% endblock %%}" % (
+                level - 1, level, level, level + 1))
+    return "level%d.tmpl" % depth
+
+
+def best_time(function, repeat=5):
+    return min(timeit.repeat(function, number=1, repeat=repeat))
+
+
+def percentile(samples, fraction):
+    """ The nearest rank percentile of the samples.
+
+    >>> percentile([4, 1, 3, 2, 5], 0.5)
+    3
+    >>> percentile(list(range(1, 101)), 0.99)
+    99
+    """
+    samples = sorted(samples)
+    rank = int(math.ceil(fraction * len(samples))) - 1
+    return samples[min(max(rank, 0), len(samples) - 1)]
+
+
+def peak_memory(function):
+    """ The peak of memory allocated during a call of function, in bytes, or None if it cannot be measured. """
+    if tracemalloc is None:
+        return None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(function, min_time=0.2, min_samples=5, max_samples=10000):
+    """ Call function until min_time is spent, at least min_samples times, and return the statistics of the timings. """
+    timer = timeit.default_timer
+    samples = []
+    spent = 0.0
+    gc.collect()
+    while len(samples) < min_samples or (spent < min_time and len(samples) < max_samples):
+        start = timer()
+        function()
+        samples.append(timer() - start)
+        spent += samples[-1]
+    return {
+        "samples": len(samples),
+        "min": min(samples),
+        "mean": spent / len(samples),
+        "p50": percentile(samples, 0.5),
+        "p90": percentile(samples, 0.9),
+        "p99": percentile(samples, 0.99),
+        "throughput": len(samples) / spent if spent else None,
+        "peak_memory": peak_memory(function),
+    }
+
+
+def stages(source, data_model, template):
+    """ The timed functions of a case: each step of the pipeline, then the public API. """
+    tokens = engine.tokenize(source)
+    parsed = engine.parse(tokens)
+    # Older checkouts resolve inheritance when evaluating, newer ones when loading the template
+    evaluated = template.parsed_template if getattr(template, "parsed_template", None) else parsed
+    return [
+        ("tokenize", lambda: engine.tokenize(source)),
+        ("parse", lambda: engine.parse(tokens)),
+        ("eval", lambda: engine.eval_(evaluated, data_model)),
+        ("render", lambda: template.render(data_model)),
+    ]
+
+
+def cases(quick=False):
+    """ Yield the cases as (case, parameters, source, data model, template). """
+    for sections in ((10, 100) if quick else (10, 100, 1000)):
+        source = make_template(sections, depth=2)
+        yield "size", {"sections": sections}, source, make_data_model(), template_from_string(source)
+    for depth in ((1, 5) if quick else (1, 5, 20)):
+        source = make_template(10, depth=depth)
+        yield "depth", {"depth": depth}, source, make_data_model(), template_from_string(source)
+    for elements in ((10, 1000) if quick else (10, 1000, 10000)):
+        source = make_template(1, depth=1)
+        yield "cardinality", {"elements": elements}, source, make_data_model(elements), template_from_string(source)
+    if not hasattr(engine, "Environment"):
+        # This checkout loads parents relatively to the working directory only
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        for depth in ((1, 4) if quick else (1, 4, 16)):
+            name = make_inheritance_chain(directory, depth)
+            with open(os.path.join(directory, name)) as file_:
+                source = file_.read()
+            template = engine.Environment([directory]).get_template(name)
+            yield "inheritance", {"depth": depth}, source, make_data_model(), template
+    finally:
+        shutil.rmtree(directory)
+
+
+def git_revision(directory):
+    try:
+        import subprocess
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=directory, stderr=subprocess.STDOUT).decode().strip()
+    except Exception:
+        return None
+
+
+def run(quick=False, min_time=0.2):
+    """ Run the suite, return the results with the description of the environment. """
+    directory = os.path.dirname(os.path.abspath(engine.__file__))
+    results = []
+    for case, parameters, source, data_model, template in cases(quick):
+        for stage, function in stages(source, data_model, template):
+            result = {"case": case, "parameters": parameters, "stage": stage}
+            try:
+                result.update(measure(function, min_time))
+            except Exception as error:
+                # Older checkouts do not support every case
+                result["error"] = "%s: %s" % (type(error).__name__, error)
+                sys.stderr.write("%-50s %s\n" % (result_key(result), result["error"]))
+            else:
+                sys.stderr.write("%-50s %12.6f\n" % (result_key(result), result["p50"]))
+            results.append(result)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "checkout": directory,
+            "revision": git_revision(directory),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def result_key(result):
+    return "%s %s %s" % (result["case"], json.dumps(result["parameters"], sort_keys=True), result["stage"])
+
+
+def compare(old, new, threshold=0.1, statistic="p50"):
+    """ Compare the results of two runs. Return the lines of a report, and the keys of the results slower by more than threshold.
+
+    >>> old = {"results": [{"case": "size", "parameters": {"sections": 10}, "stage": "parse", "p50": 1.0}]}
+    >>> new = {"results": [{"case": "size", "parameters": {"sections": 10}, "stage": "parse", "p50": 1.5}]}
+    >>> lines, regressions = compare(old, new)
+    >>> regressions
+    ['size {"sections": 10} parse']
+    >>> print(lines[1])
+    size {"sections": 10} parse                            1.000000     1.500000   +50.0% regression
+    """
+    old_results = dict((result_key(result), result) for result in old["results"])
+    lines = ["%-50s %12s %12s %8s" % ("benchmark", "old " + statistic, "new " + statistic, "change")]
+    regressions = []
+    for result in new["results"]:
+        key = result_key(result)
+        if "error" in result:
+            lines.append("%-50s %s" % (key, result["error"]))
+            continue
+        if key not in old_results or "error" in old_results[key]:
+            lines.append("%-50s %12s %12.6f" % (key, "-", result[statistic]))
+            continue
+        before, after = old_results[key][statistic], result[statistic]
+        change = (after - before) / before if before else 0.0
+        line = "%-50s %12.6f %12.6f %+7.1f%%" % (key, before, after, change * 100)
+        if change > threshold:
+            line += " regression"
+            regressions.append(key)
+        lines.append(line)
+    return lines, regressions
+
+
+def bench_parse_scaling(sizes=(100, 200, 400, 800, 1600, 3200)):
+    """ Parsing time must grow linearly with the size of the template, whatever the nesting depth. """
+    print("parse scaling")
+    print("%8s %8s %12s %16s" % ("depth", "tokens", "seconds", "us per token"))
+    for depth in (1, 10):
+        for size in sizes:
+            tokens = engine.tokenize(make_template(size, depth))
+            seconds = best_time(lambda: engine.parse(tokens))
+            print("%8d %8d %12.6f %16.3f" % (depth, len(tokens), seconds, seconds / len(tokens) * 1e6))
+
+
+def template_from_string(source, **kwargs):
+    return engine.Template(StringIO(source), **kwargs)
+
+
+def bench_render_many(renders=2000, workers=(1, 2, 4, 8)):
+    """ Rendering throughput of one shared template, over thread and process pools. """
+    try:
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    except ImportError:
+        print("render_many: concurrent.futures is not available")
+        return
+    template = template_from_string(make_template(20))
+    data_models = [{"name": "Eva %d" % index, "age": 23, "friends": ["Billy", "John", "Emily"]} for index in range(renders)]
+    print("render_many")
+    print("%8s %8s %16s" % ("pool", "workers", "renders per s"))
+    start = time.time()
+    template.render_many(data_models)
+    print("%8s %8d %16.0f" % ("none", 1, renders / (time.time() - start)))
+    for executor_class in (ThreadPoolExecutor, ProcessPoolExecutor):
+        for count in workers:
+            executor = executor_class(count)
+            # Start the workers before timing
+            executor.map(abs, range(count))
+            start = time.time()
+            template.render_many(data_models, executor=executor, batch_size=renders // (count * 4))
+            seconds = time.time() - start
+            executor.shutdown()
+            print("%8s %8d %16.0f" % (executor_class.__name__[:-len("PoolExecutor")].lower(), count, renders / seconds))
+
+
+def bench_loop_invariant(sizes=(100000, 200000)):
+    """ Loops whose body mostly does not depend on the loop variable, with and without hoisting. """
+    parsed = engine.parse(engine.tokenize("{% for friend in friends %}{{ friend }}: {% if age >= 18 %}{{ greeting + name }}, aged {{ age + 1 }}{% endif %}. {% endfor %}"))
+    hoisted, not_hoisted = engine.compile_(parsed), engine.compile_(parsed, hoisting=False)
+    print("loop invariant hoisting")
+    print("%8s %12s %12s %12s" % ("elements", "hoisted", "not hoisted", "interpreted"))
+    for size in sizes:
+        data_model = make_data_model(size)
+        print("%8d %12.4f %12.4f %12.4f" % (
+            size,
+            best_time(lambda: hoisted(data_model), repeat=3),
+            best_time(lambda: not_hoisted(data_model), repeat=3),
+            best_time(lambda: engine.eval_(parsed, data_model), repeat=3),
+        ))
+
+
+def bench_stream_file(sections=(10000, 40000)):
+    """ Peak memory of rendering a template file as it is read, compared to reading it whole. """
+    if tracemalloc is None:
+        print("stream_file: tracemalloc is not available")
+        return
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "large.tmpl")
+    data_model = make_data_model()
+    print("stream file")
+    print("%8s %12s %16s %16s" % ("sections", "file MB", "streamed peak MB", "whole peak MB"))
+    try:
+        for count in sections:
+            with open(path, "w") as file_:
+                file_.write(make_template(count, depth=2))
+
+            def streamed():
+                for chunk in engine.generate_file(path, data_model):
+                    pass
+
+            def whole():
+                with open(path) as file_:
+                    engine.Template(file_, compiled=False, optimized=False).render(data_model)
+
+            print("%8d %12.1f %16.3f %16.3f" % (count, os.path.getsize(path) / 1e6, peak_memory(streamed) / 1e6, peak_memory(whole) / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_columnar(rows=(100000,)):
+    """ Loops over tabular data, as records and as columns, vectorized, compiled per row and interpreted. """
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    parsed = engine.parse(engine.tokenize(
+        "{% for row in rows %}<tr><td>{{ row.name }}</td><td>{{ row.total }}</td><td>{% if row.total > 500 %}{{ large }}{% else %}{{ small }}{% endif %}</td></tr>{% endfor %}"))
+    vectorized, per_row = engine.compile_(parsed), engine.compile_(parsed, vectorized=False)
+    print("columnar")
+    print("%8s %10s %12s %12s %12s" % ("rows", "input", "vectorized", "per row", "interpreted"))
+    for size in rows:
+        names, totals = ["name %d" % index for index in range(size)], [index % 1000 for index in range(size)]
+        inputs = [
+            ("records", [{"name": name, "total": total} for name, total in zip(names, totals)]),
+            ("columns", {"name": names, "total": totals}),
+        ]
+        if numpy is not None:
+            inputs.append(("numpy", {"name": numpy.array(names), "total": numpy.array(totals)}))
+        for kind, table in inputs:
+            data_model = {"rows": table, "large": "large", "small": "small"}
+            print("%8d %10s %12.4f %12.4f %12.4f" % (
+                size, kind,
+                best_time(lambda: vectorized(data_model), repeat=3),
+                best_time(lambda: per_row(data_model), repeat=3),
+                best_time(lambda: engine.eval_(parsed, data_model), repeat=3),
+            ))
+
+
+def bench_render_bytes(sizes=(10000, 100000)):
+    """ Peak memory and time of rendering to bytes, with render_bytes and by encoding the output of render. """
+    if tracemalloc is None:
+        print("render_bytes: tracemalloc is not available")
+        return
+    template = template_from_string(
+        "{% for friend in friends %}<li>{{ friend }}{% if age >= 18 %}, adult{% endif %}</li>{% for group in groups %}{{ group }} {% endfor %}{% endfor %}")
+    interpreted = template_from_string(template.template, compiled=False)
+    print("render bytes")
+    print("%8s %10s %14s %14s %12s" % ("elements", "output MB", "path", "peak MB", "seconds"))
+    for size in sizes:
+        data_model = make_data_model(size)
+        data_model["groups"] = ["a", "b", "c"]
+        for name, function in [
+            ("encoded", lambda: template.render(data_model).encode("utf-8")),
+            ("bytes", lambda: template.render_bytes(data_model)),
+            ("interp enc", lambda: interpreted.render(data_model).encode("utf-8")),
+            ("interp bytes", lambda: interpreted.render_bytes(data_model)),
+        ]:
+            # The first render gives render_bytes its estimate of the output size
+            output = function()
+            print("%8d %10.1f %14s %14.3f %12.4f" % (size, len(output) / 1e6, name, peak_memory(function) / 1e6, best_time(function, repeat=3)))
+
+
+def bench_render_parallel(sections=8, elements=(20000, 200000), processes=(1, 2, 4, 8)):
+    """ Rendering a template made of independent blocks sequentially, and on pools of processes. """
+    template = template_from_string("".join(
+        "{%% block section%d %%}{%% for friend in friends %%}<li>{{ friend }} %d</li>{%% for group in groups %%}{{ group }}{%% endfor %%}{%% endfor %%}{%% endblock %%}" % (index, index)
+        for index in range(sections)))
+    print("render parallel, %d cpus" % multiprocessing.cpu_count())
+    print("%8s %10s %12s" % ("elements", "processes", "seconds"))
+    for size in elements:
+        data_model = make_data_model(size)
+        data_model["groups"] = ["a", "b"]
+        print("%8d %10s %12.4f" % (size, "none", best_time(lambda: template.render(data_model), repeat=3)))
+        for count in processes:
+            # The pool is started beforehand, as a caller keeps it from one render to the next
+            pool = multiprocessing.Pool(count)
+            try:
+                print("%8d %10d %12.4f" % (size, count, best_time(lambda: template.render_parallel(data_model, executor=pool), repeat=3)))
+            finally:
+                pool.terminate()
+
+
+def import_time(repeat=5):
+    """ The best time to start Python and import the template module, minus the time to start Python. """
+    directory = os.path.dirname(os.path.abspath(engine.__file__))
+    def start(statement):
+        return best_time(lambda: subprocess.check_call([sys.executable, "-c", statement], cwd=directory), repeat=repeat)
+    return start("import template") - start("pass")
+
+
+def bench_warmup(counts=(100, 1000), threads=(1, 4)):
+    """ Import time, and loading a whole set of templates with Environment.warmup, from source and precompiled. """
+    print("import template: %.4f s" % import_time())
+    print("warmup")
+    print("%10s %12s %8s %9s %12s %16s" % ("templates", "precompiled", "threads", "gc paused", "seconds", "slowest seconds"))
+    for count in counts:
+        directory = tempfile.mkdtemp()
+        try:
+            for index in range(count):
+                with open(os.path.join(directory, "page%d.tmpl" % index), "w") as file_:
+                    file_.write(make_template(20))
+            for precompiled in (False, True):
+                if precompiled:
+                    # Build the precompiled files once
+                    engine.Environment([directory], precompiled=True).warmup()
+                for count_threads in threads:
+                    for pause_gc in (False, True):
+                        environment = engine.Environment([directory], precompiled=precompiled)
+                        start = time.time()
+                        times = environment.warmup(threads=count_threads, pause_gc=pause_gc)
+                        print("%10d %12s %8d %9s %12.4f %16.6f" % (
+                            count, precompiled, count_threads, pause_gc, time.time() - start, max(times.values())))
+        finally:
+            shutil.rmtree(directory)
+
+
+BENCHMARKS = {
+    "warmup": bench_warmup,
+    "render-parallel": bench_render_parallel,
+    "render-bytes": bench_render_bytes,
+    "columnar": bench_columnar,
+    "parse-scaling": bench_parse_scaling,
+    "render-many": bench_render_many,
+    "loop-invariant": bench_loop_invariant,
+    "stream-file": bench_stream_file,
+}
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for the template engine")
+    commands = parser.add_subparsers(dest="command")
+    run_parser = commands.add_parser("run", help="run the benchmark suite, output JSON")
+    run_parser.add_argument("--output", help="file to write the results to, standard output by default")
+    run_parser.add_argument("--checkout", help="benchmark the template module of this directory")
+    run_parser.add_argument("--quick", action="store_true", help="fewer and smaller cases")
+    run_parser.add_argument("--min-time", type=float, default=0.2, help="seconds spent timing each stage of each case")
+    compare_parser = commands.add_parser("compare", help="compare two runs, exit with 1 on regressions")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="relative slow down reported as a regression")
+    compare_parser.add_argument("--statistic", default="p50", choices=["min", "mean", "p50", "p90", "p99"])
+    for name, function in sorted(BENCHMARKS.items()):
+        benchmark_parser = commands.add_parser(name, help=function.__doc__.strip())
+        benchmark_parser.add_argument("--checkout", help="benchmark the template module of this directory")
+    arguments = parser.parse_args(arguments)
+
+    if arguments.command == "compare":
+        with open(arguments.old) as old:
+            old = json.load(old)
+        with open(arguments.new) as new:
+            new = json.load(new)
+        lines, regressions = compare(old, new, arguments.threshold, arguments.statistic)
+        print("\n".join(lines))
+        return 1 if regressions else 0
+
+    load_engine(getattr(arguments, "checkout", None))
+    if arguments.command == "run":
+        results = json.dumps(run(arguments.quick, arguments.min_time), indent=2, sort_keys=True)
+        if arguments.output:
+            with open(arguments.output, "w") as output:
+                output.write(results)
+        else:
+            print(results)
+    elif arguments.command in BENCHMARKS:
+        BENCHMARKS[arguments.command]()
+    else:
+        for name in sorted(BENCHMARKS):
+            BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
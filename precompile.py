@@ -0,0 +1,62 @@
+"""
+Precompile the templates of directories, so that loading them neither tokenizes, parses nor compiles them:
+    python precompile.py templates/
+
+Each template file, like templates/page.tmpl, gets a precompiled file next to it, templates/page.tmplc,
+that Environment(precompiled=True) loads instead. Only the stale or missing ones are built, unless --force is given.
+To list them without building them, exiting with 1 if there are any:
+    python precompile.py --check templates/
+"""
+
+import sys
+import argparse
+
+from template import Environment, TemplateSyntaxError, TemplateNotFound
+
+
+def precompile(directory, extension=".tmpl", force=False, check=False):
+    """ Precompile the templates of the directory. Return the number of templates built, up to date and failed. """
+    environment = Environment([directory], precompiled=True)
+    built, up_to_date, failed = 0, 0, 0
+    for name in environment.list_templates(extension):
+        path = environment.resolve(name)
+        if not force and environment.load_artifact(name, path) is not None:
+            up_to_date += 1
+            continue
+        if check:
+            print("stale: %s" % path)
+            failed += 1
+            continue
+        try:
+            template = environment.build(name, path)
+        except (TemplateSyntaxError, TemplateNotFound, ValueError) as error:
+            print("failed: %s: %s" % (path, error))
+            failed += 1
+            continue
+        if not environment.save_artifact(template, path):
+            print("failed: %s: cannot write the precompiled template" % path)
+            failed += 1
+            continue
+        built += 1
+    return built, up_to_date, failed
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Precompile templates")
+    parser.add_argument("directories", nargs="+", help="directories of templates, searched for the templates they extend")
+    parser.add_argument("--extension", default=".tmpl", help="extension of the template files")
+    parser.add_argument("--force", action="store_true", help="build them all, even those up to date")
+    parser.add_argument("--check", action="store_true", help="only list the missing or stale ones, exit with 1 if any")
+    arguments = parser.parse_args(arguments)
+
+    status = 0
+    for directory in arguments.directories:
+        built, up_to_date, failed = precompile(directory, arguments.extension, arguments.force, arguments.check)
+        print("%s: %d built, %d up to date, %d %s" % (directory, built, up_to_date, failed, "stale" if arguments.check else "failed"))
+        if failed:
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -6,10 +6,29 @@ The template engine is a compiler, so it has the three classic steps of a compil
  - parse
  - eval
 Each step is implemented in a separate function which has the same name as the step.
+
+Instead of evaluating the parsed template on each render, compile_ can turn it into a Python function once.
+This is what the Template class does by default.
 """
 
 import re
+import io
+import os
+import gc
+import sys
+import mmap
+import zlib
+import pickle
+import marshal
 import math 
+import operator
+import time
+import types
+import timeit
+import functools
+import itertools
+import threading
+import collections
 
 
 EXPRESSION_START = "{{"
@@ -17,34 +36,51 @@ EXPRESSION_END = "}}"
 STATEMENT_START = "{%"
 STATEMENT_END = "%}"
 TOKEN_REGEX = re.compile(r"(%s.*?%s|%s.*?%s)" % (EXPRESSION_START, EXPRESSION_END, STATEMENT_START, STATEMENT_END))
+# The same, for templates read as bytes, like memory-mapped files
+BYTES_TOKEN_REGEX = re.compile(TOKEN_REGEX.pattern.encode('ascii'))
 _GLOBAL_ENV = {
     'statements': {
         'len': lambda x, data_model: len(x),
     },
     'variables': {},
+    # Builtin functions where possible, they are cheaper to call than lambdas
     'operators': {
         'binary': {
-            '+': lambda x, y: x+y,
-            '-': lambda x, y: x-y,
-            '*': lambda x, y: x*y,
-            '/': lambda x, y: float(x)/y,
-            '/': lambda x, y: x % y,
-            '>': lambda x, y: x > y,
-            '<': lambda x, y: x < y,
-            '>=': lambda x, y: x >= y,
-            '<=': lambda x, y: x <= y,
-            '==': lambda x, y: x == y,
-            '!=': lambda x, y: x != y,
+            '+': operator.add,
+            '-': operator.sub,
+            '*': operator.mul,
+            '/': operator.mod,
+            '>': operator.gt,
+            '<': operator.lt,
+            '>=': operator.ge,
+            '<=': operator.le,
+            '==': operator.eq,
+            '!=': operator.ne,
             '^': math.pow,
             'in': lambda x, y: x in y,
         },
         'unary': {
-            '-': lambda x: -x,
+            '-': operator.neg,
         },
     },
-    'blocks': {
+    'compilers': {},
+    # Statements holding bodies of parsed tokens, and their indexes in the parsed statement
+    'bodies': {
+        'if': (2, 3),
+        'for': (2,),
+        'block': (2,),
+        'cache': (2,),
+    },
+    # Statements which open a block, and the tag closing it
+    'end_tags': {
+        'if': 'endif',
+        'for': 'endfor',
+        'block': 'endblock',
+        'cache': 'endcache',
     },
 }
+# Marks a missing value where None is a legitimate one
+_MISSING = object()
 
 
 def is_expr(token):
@@ -68,61 +104,6 @@ def is_stmt(token, type_=None):
     else:
         return False
 
-def find_next_else(tokens, index):
-    """
-    >>> l = ['{% if age >= 18 %}', '{% if age >= 65 %}', 'senior', '{% else %}', '{% endif %}', \
-    '{% if age >= 21 %}', 'can drink', '{% else %}', '{% endif %}', \
-    '{% else  %}', '{%  if moon == "full" %}', 'yup, full', '{% else%}', '{% endif %}', '{% endif %}']
-    >>> find_next_else(l, 1)
-    9
-    >>> l = ['{% if age >= 18 %}', '{% if age >= 65 %}', 'senior', '{% else %}', '{% endif %}', '{% else %}', '{% endif %}']
-    >>> find_next_else(l, 1)
-    5
-
-    The straightforward case
-    >>> l = ['{% if age >= 18 %}', 'adult', '{% else %}', '{% endif %}']
-    >>> find_next_else(l, 1)
-    2
-    """
-    open_ifs = 0
-    for ix, token in enumerate(tokens[index:]):
-        if is_stmt(token, "if"):
-            open_ifs += 1
-        if is_stmt(token, "endif"):
-            open_ifs -= 1
-        if open_ifs <= 0 and is_stmt(token, "else"):
-            return index + ix
-    return -1
-
-def find_next_endif(tokens, index):
-    """
-    >>> l = ['{% if age >= 18 %}', '{% if age >= 65 %}', 'senior', '{% else %}', '{% endif %}', \
-    '{% if age >= 21 %}', 'can drink', '{% else %}', '{% endif %}', \
-    '{% else %}', '{% endif %}']
-    >>> find_next_endif(l, 1)
-    10
-    >>> l = ['{% if age >= 18 %}', '{% if age >= 65 %}', 'senior', '{% else %}', '{% endif %}', '{% else %}', '{% endif %}']
-    >>> find_next_endif(l, 1)
-    6
-
-    The straightforward case
-    >>> l = ['{% if age >= 18 %}', 'adult', '{% else %}', '{% endif %}']
-    >>> find_next_endif(l, 1)
-    3
-    """
-    open_ifs = 0
-    for ix, token in enumerate(tokens[index:]):
-        if is_stmt(token, "if"):
-            open_ifs += 1
-        elif is_stmt(token, "endif"):
-            open_ifs -= 1
-            if open_ifs == 0:
-                continue
-        if open_ifs <= 0 and is_stmt(token, "endif"):
-            return index + ix
-    return -1
-
-
 def tokenize(template):
     """Tokenize the text template
     This is the first step of the template engine.
@@ -171,20 +152,340 @@ def tokenize(template):
     >>> tokenize("{% block greeting %}Hello there, {{ Name }}!{% endblock %}")
     ['{% block greeting %}', 'Hello there, ', '{{ Name }}', '!', '{% endblock %}']
     """
+    # TOKEN_REGEX.split leaves an empty string before and after template tags, if the tags are at the beginning or the end.
+    # Let's filter these. Incidentally, this will also filter all other empty strings, like and empty else block. So the parser will have to handle this.
+    # Splitting is faster than iter_tokens, which is for templates too large to be held in memory.
+    return [token for token in TOKEN_REGEX.split(template) if token]
 
-    if len(template) == 0:
-        return []
+def iter_tokens(template):
+    """ Yield the tokens of the template with their offset in it, one at a time, like tokenize without the list.
+    There are no empty tokens, so the parser has to handle empty else blocks.
+    The template can also be bytes, or a memory-mapped file, decoded from UTF-8 token by token, see generate_file.
 
-    tokens = TOKEN_REGEX.split(template)
+    >>> list(iter_tokens("Hello {{ name }}!"))
+    [(0, 'Hello '), (6, '{{ name }}'), (16, '!')]
+    >>> list(iter_tokens(b"{% if age >= 18 %}adult{% endif %}")) == [(0, '{% if age >= 18 %}'), (18, 'adult'), (23, '{% endif %}')]
+    True
+    """
+    if isinstance(template, (str, type(u''))):
+        regex, decode = TOKEN_REGEX, None
+    else:
+        regex = BYTES_TOKEN_REGEX
+        # Python 2 strings are bytes already
+        decode = None if bytes is str else lambda token: token.decode('utf-8')
+    start = 0
+    for match in regex.finditer(template):
+        if match.start() > start:
+            token = template[start:match.start()]
+            yield start, token if decode is None else decode(token)
+        token = match.group()
+        yield match.start(), token if decode is None else decode(token)
+        start = match.end()
+    if start < len(template):
+        token = template[start:]
+        yield start, token if decode is None else decode(token)
+
+class TemplateSyntaxError(ValueError):
+    """ Raised when the template cannot be parsed. position is the index of the offending token,
+    offset its index in the source, when the parser is given it, see iter_parse. """
+
+    def __init__(self, message, position=None, offset=None):
+        ValueError.__init__(self, message)
+        self.position = position
+        self.offset = offset
+
+def parse_operand(token):
+    """ Tell literals from variables. Return (is_variable, value).
+
+    >>> parse_operand('12'), parse_operand('"Superman"'), parse_operand('friend')
+    ((False, 12), (False, 'Superman'), (True, 'friend'))
+    """
+    if type(token) != str:
+        return False, token
+    if token.isdigit():
+        return False, int(token)
+    if len(token) >= 2 and token[0] == token[-1] and token[0] in '"\'':
+        return False, token[1:-1]
+    return True, token
+
+def split_variable(name):
+    """ Split a variable into its name in the data model and the path of fields read from its value.
+
+    >>> split_variable('row.user.name'), split_variable('name')
+    (('row', ('user', 'name')), ('name', ()))
+    """
+    names = name.split('.')
+    return names[0], tuple(names[1:])
 
-    # For some reason, TOKEN_REGEX.split leaves an empty string before and after template tags, if the tags are at the beginning or the end.
-    # Let's filter these. Incidentally, this will also filter all other empty strings, like and empty else block. So the parser will have to handle this.
-    tokens = [token for token in tokens if token]
+def lookup_fields(value, fields, name):
+    """ Follow the path of fields from the value of a variable: each is an item of a mapping, or else an attribute.
+    Like any variable, a variable missing from the data model, given as _MISSING, stands for its own name.
+
+    >>> lookup_fields({'user': {'name': 'Eva'}}, ('user', 'name'), 'row.user.name')
+    'Eva'
+    >>> lookup_fields(_MISSING, ('user',), 'row.user')
+    'row.user'
+    """
+    if value is _MISSING:
+        return name
+    for field in fields:
+        try:
+            value = value[field]
+        except (KeyError, IndexError, TypeError):
+            value = getattr(value, field)
+    return value
+
+class Expression(object):
+    """ A parsed expression: its operands are classified as literals or variables, and its operator is looked up, once.
+    Evaluating it is a call to its evaluate method, which does not allocate or look anything up but the variables.
+    It compares equal to, and looks like, the tuple of its tokens.
+
+    >>> exp = Expression((12, '-', 'apple_count'))
+    >>> exp
+    (12, '-', 'apple_count')
+    >>> exp.variables
+    ('apple_count',)
+    >>> exp.evaluate({'apple_count': 5})
+    7
+
+    A variable missing from the data model stands for its own name. Quoted strings are literals, never looked up:
+    >>> Expression(('name', '==', '"name"')).evaluate({'name': 'Eva'}), Expression(('name', '==', '"name"')).evaluate({})
+    (False, True)
+
+    Dots read fields of the value of a variable, see lookup_fields:
+    >>> exp = Expression(('row.total', '*', 2))
+    >>> exp.variables, exp.evaluate({'row': {'total': 21}})
+    (('row',), 42)
+
+    Like Statement, it remembers the index of its token and the name of its template, set by parse.
+    """
+    __slots__ = ('tokens', 'operator', 'operands', 'variables', 'evaluate', 'position', 'template')
+
+    def __init__(self, tokens, position=None, template=None):
+        self.tokens = tokens
+        self.position = position
+        self.template = template
+        self.operator, operands = self.split_tokens(tokens)
+        self.operands = tuple([parse_operand(operand) for operand in operands])
+        self.variables = tuple([split_variable(value)[0] for is_variable, value in self.operands if is_variable])
+
+    @classmethod
+    def split_tokens(cls, tokens):
+        """ Return the operator of the tokens, and their operands. """
+        if len(tokens) == 3:
+            return cls.lookup_operator('binary', tokens[1]), (tokens[0], tokens[2])
+        elif len(tokens) == 2:
+            return cls.lookup_operator('unary', tokens[0]), (tokens[1],)
+        # No operator, only the first operand counts
+        return None, tokens[:1]
+
+    def __getattr__(self, name):
+        # The evaluate function is made on first use: compiled templates never use it
+        if name != 'evaluate':
+            raise AttributeError(name)
+        self.evaluate = self.make_evaluate()
+        return self.evaluate
+
+    @staticmethod
+    def lookup_operator(kind, op):
+        if op not in _GLOBAL_ENV['operators'][kind]:
+            raise ValueError("Unknown %s operator: %s" % (kind, op))
+        return _GLOBAL_ENV['operators'][kind][op]
+
+    def make_evaluate(self):
+        op = self.operator
+        if any(is_variable and '.' in value for is_variable, value in self.operands):
+            return self.make_evaluate_fields()
+        if len(self.operands) == 2:
+            (left_is_variable, left), (right_is_variable, right) = self.operands
+            if left_is_variable and right_is_variable:
+                return lambda data_model: op(data_model.get(left, left), data_model.get(right, right))
+            elif left_is_variable:
+                return lambda data_model: op(data_model.get(left, left), right)
+            elif right_is_variable:
+                return lambda data_model: op(left, data_model.get(right, right))
+            return lambda data_model: op(left, right)
+        [(is_variable, value)] = self.operands
+        if op is None:
+            if is_variable:
+                return lambda data_model: data_model.get(value, value)
+            return lambda data_model: value
+        if is_variable:
+            return lambda data_model: op(data_model.get(value, value))
+        return lambda data_model: op(value)
+
+    def make_evaluate_fields(self):
+        """ Like make_evaluate, when some operands read fields. """
+        def getter(is_variable, value):
+            if not is_variable:
+                return lambda data_model: value
+            name, fields = split_variable(value)
+            if not fields:
+                return lambda data_model: data_model.get(name, name)
+            return lambda data_model: lookup_fields(data_model.get(name, _MISSING), fields, value)
+        getters = [getter(is_variable, value) for is_variable, value in self.operands]
+        op = self.operator
+        if len(getters) == 2:
+            left, right = getters
+            return lambda data_model: op(left(data_model), right(data_model))
+        [operand] = getters
+        if op is None:
+            return operand
+        return lambda data_model: op(operand(data_model))
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, index):
+        return self.tokens[index]
+
+    def __iter__(self):
+        return iter(self.tokens)
+
+    def __eq__(self, other):
+        if type(other) == Expression:
+            other = other.tokens
+        return self.tokens == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.tokens)
+
+    def __repr__(self):
+        return repr(self.tokens)
+
+    def __reduce__(self):
+        # Functions cannot be pickled, the operator is looked up again, but the operands are not classified again
+        return rebuild_expression, (self.tokens, self.position, self.template, self.operands, self.variables)
+
+def rebuild_expression(tokens, position, template, operands, variables):
+    """ Return the expression, as pickled by Expression.__reduce__. """
+    exp = Expression.__new__(Expression)
+    exp.tokens, exp.position, exp.template = tokens, position, template
+    exp.operator = Expression.split_tokens(tokens)[0]
+    exp.operands, exp.variables = operands, variables
+    return exp
+
+class Statement(tuple):
+    """ A parsed statement: the tuple of its name, its parameters and its bodies.
+    It remembers where it comes from, the index of its token and the name of its template, to report errors and profiles.
+    It compares equal to, and looks like, a plain tuple: parsed templates written by hand hold plain tuples.
+
+    >>> stmt = Statement(('if', ('age', '>=', 18), 'adult', ''), position=3, template='test.tmpl')
+    >>> stmt, stmt.position, stmt.template
+    (('if', ('age', '>=', 18), 'adult', ''), 3, 'test.tmpl')
+    >>> stmt == ('if', ('age', '>=', 18), 'adult', '')
+    True
+    """
+
+    def __new__(cls, items, position=None, template=None):
+        stmt = tuple.__new__(cls, items)
+        stmt.position = position
+        stmt.template = template
+        return stmt
 
-    return tokens
+    def __reduce__(self):
+        return Statement, (tuple(self), self.position, self.template)
 
-def parse(tokens):
-    """Parse the tokenized template.
+class CacheParams(tuple):
+    """ The parameters of a cache statement: its key and its time to live. It holds the fragment_id of the body,
+    computed once when the statement is built: the body only changes by building the statement again, see rebuild_statement.
+
+    >>> params = CacheParams((('name',), 60), fragment_id('Hello'))
+    >>> params == (('name',), 60), params.fragment_id == fragment_id('Hello')
+    (True, True)
+    """
+
+    def __new__(cls, items, fragment_id):
+        params = tuple.__new__(cls, items)
+        params.fragment_id = fragment_id
+        return params
+
+    def __reduce__(self):
+        return CacheParams, (tuple(self), self.fragment_id)
+
+def rebuild_statement(stmt, items):
+    """ Return the statement made of items, coming from the same place as stmt. """
+    if items[0] == 'cache':
+        # Its body may have changed
+        items = ['cache', CacheParams(items[1], fragment_id(items[2]))] + list(items[2:])
+    return Statement(items, getattr(stmt, 'position', None), getattr(stmt, 'template', None))
+
+def parse_expression(token):
+    """
+    >>> parse_expression(" 12 - apple_count ")
+    (12, '-', 'apple_count')
+    >>> type(parse_expression(" 12 - apple_count ")) == Expression
+    True
+    """
+    def make_int(token):
+        # @TODO This only processes ints, why not floats and other numerical types ?
+        if token.isdigit():
+            token = int(token)
+        return token
+    return Expression(tuple([make_int(subtoken) for subtoken in token.split()]))
+
+def unpack_len_one_list(l):
+    if isinstance(l, list):
+        if len(l) == 1:
+            return l[0]
+        # If empty list, it's an empty block, so return ""
+        elif len(l) == 0:
+            return ""
+    return l
+
+def is_expression_shape(tokens):
+    """ Can the tokens be an expression: a single operand, a unary operator and its operand, or a binary expression ? """
+    operators = _GLOBAL_ENV['operators']
+    if len(tokens) == 1:
+        return tokens[0] not in operators['unary'] and tokens[0] not in operators['binary']
+    if len(tokens) == 2:
+        return tokens[0] in operators['unary']
+    return len(tokens) == 3 and tokens[1] in operators['binary']
+
+def make_statement(statement, params, branches, position=None, template=None, location=None):
+    """ Build the parsed token of a statement which opens a block, once its end tag is reached.
+    Errors are reported at the location of the statement, or at its position if not given, see iter_parse.
+
+    >>> make_statement('if', ['age', '>=', 18], [['adult'], []])
+    ('if', ('age', '>=', 18), 'adult', '')
+    >>> make_statement('for', ['friend', 'in', 'friends'], [[('friend',), ',']])
+    ('for', ['friend', 'in', 'friends'], [('friend',), ','])
+
+    The key of a cache statement is an expression, optionally followed by a time to live in seconds:
+    >>> make_statement('cache', ['"friends"', '+', 'name', '60'], [[('friends',)]])
+    ('cache', (('"friends"', '+', 'name'), 60), ('friends',))
+    >>> make_statement('cache', ['-', 'x'], [[('friends',)]]), make_statement('cache', ['-', 'x', '60'], [[('friends',)]])
+    (('cache', (('-', 'x'), None), ('friends',)), ('cache', (('-', 'x'), 60), ('friends',)))
+    """
+    branches = [unpack_len_one_list(branch) for branch in branches]
+    if statement == "if":
+        params = parse_expression(" ".join([str(param) for param in params]))
+        params.position, params.template = position, template
+        if len(branches) == 1:
+            # No else
+            branches.append("")
+    elif statement == "block":
+        params = unpack_len_one_list(params)
+    elif statement == "cache":
+        # The key is a single operand, a unary or a binary expression, followed by the ttl if it is a number
+        ttl = None
+        location = 'token %s' % position if location is None else location
+        if params and params[-1].isdigit() and is_expression_shape(params[:-1]):
+            params, ttl = params[:-1], int(params[-1])
+        elif not is_expression_shape(params):
+            if len(params) in (2, 4):
+                raise TemplateSyntaxError("Invalid time to live of {%% cache %%} at %s: %s" % (location, params[-1]), position)
+            raise TemplateSyntaxError("Missing key of {%% cache %%} at %s" % location, position)
+        key = parse_expression(" ".join(params))
+        key.position, key.template = position, template
+        params = CacheParams((key, ttl), fragment_id(branches[0]))
+    return Statement([statement, params] + branches, position, template)
+
+def parse(tokens, template=None):
+    """Parse the tokenized template, see iter_parse.
     Transforms the flat list of tokens into a list-of-trees structure, respecting blocks. 
     This structure is known in the literature as an AST (abstract syntax tree).
 
@@ -224,89 +525,196 @@ def parse(tokens):
     '{% if friend == "Superman" %}', "wow, Superman, you have powerful friends!", '{% else %}', '{{friend}}', ',', '{% endif %}', '{% endfor %}', '{% else %}', 'not old enough', '{% endif %}', '!'])
     ['Condition one ', ('if', ('age', '>=', 18), ["is true, let's loop: ", ('for', ['friend', 'in', 'friends'], ('if', ('friend', '==', '"Superman"'), 'wow, Superman, you have powerful friends!', [('friend',), ',']))], 'not old enough'), '!']
 
-    Some statements do not open blocks, like extends:
-    @TODO: BREAKTHROUGH parsing extends should return the parent template plus an end_parent marker that will be used to flatten the blocks (only keep latest)
+    Some statements do not open blocks, like extends. It is resolved after parsing, see resolve_inheritance.
     >>> parse(['{% extends base.tmpl %}', '{% block greeting %}', 'Hello there!', '{% endblock %}'])
     [('extends', ('base.tmpl',)), ('block', 'greeting', 'Hello there!')]
 
+    Tags must be balanced, errors give the position of the offending token:
+    >>> def syntax_error(tokens):
+    ...     try:
+    ...         parse(tokens)
+    ...     except TemplateSyntaxError as e:
+    ...         print(e)
+    >>> syntax_error(['{% for friend in friends %}', '{{friend}}', '{% endif %}'])
+    Unexpected {% endif %} at token 2, {% for %} opened at token 0 is still open
+    >>> syntax_error(['{% if age >= 18 %}', 'adult', '{% else %}', '{% else %}', '{% endif %}'])
+    Unexpected {% else %} at token 3
+    >>> syntax_error(['Hello', '{% block greeting %}', '{% if age >= 18 %}', 'adult', '{% endif %}'])
+    Unclosed {% block %} opened at token 1
+
+    The else branch is optional:
+    >>> parse(['{% if age >= 18 %}', 'adult', '{% endif %}'])
+    [('if', ('age', '>=', 18), 'adult', '')]
+
+    Statements and expressions remember the index of their token, and the name of the template if given:
+    >>> [(node.position, node.template) for node in parse(['Hello ', '{{ name }}', '{% if age >= 18 %}', 'adult', '{% endif %}'], 'test.tmpl')[1:]]
+    [(1, 'test.tmpl'), (2, 'test.tmpl')]
     """
-    # Let's go from tokenized (flat list of tokens) to AST
-
-    if len(tokens) == 0:
-        return []
-
+    return list(iter_parse(tokens, template))
+
+def iter_parse(tokens, template=None):
+    """ Parse the tokens incrementally: yield the top level parsed tokens as soon as they are complete.
+    Fed with iter_tokens, only the statement being parsed is held in memory, not the whole template.
+    The tokens can come with their offset in the source, like those of iter_tokens: errors are then reported
+    at their line and offset, instead of the index of the token, which means little in a large file.
+
+    >>> nodes = iter_parse(iter(['Hello ', '{% if age >= 18 %}', 'adult', '{% endif %}', '{% endif %}']))
+    >>> next(nodes), next(nodes)
+    ('Hello ', ('if', ('age', '>=', 18), 'adult', ''))
+    >>> try:
+    ...     next(nodes)
+    ... except TemplateSyntaxError as e:
+    ...     print(e)
+    Unexpected {% endif %} at token 4
+    >>> nodes = iter_parse(iter_tokens('Hello\\n{% if age >= 18 %}\\nadult\\n{% endif %}{% endif %}'))
+    >>> try:
+    ...     list(nodes)
+    ... except TemplateSyntaxError as e:
+    ...     error = e
+    >>> print(error)
+    Unexpected {% endif %} at line 4, offset 42
+    >>> error.position, error.offset
+    (4, 42)
+    """
+    # Let's go from tokenized (flat list of tokens) to AST, in a single pass.
+    # Each statement opening a block pushes a frame on the stack, its end tag pops it.
+    # A frame is [statement, params, position, branches, location], the tokens are appended to the last branch.
+    # Top level tokens are appended to parsed, and handed over right away.
     parsed = []
-
-    def parse_expr(token, tokens, index):
-        subtokens = token.split()
-        def make_int(token):
-            # @TODO This only processes ints, why not floats and other numerical types ?
-            if token.isdigit():
-                token = int(token)
-            return token
-        subtokens = [make_int(subtoken) for subtoken in subtokens]
-        return tuple(subtokens)
-
-    def unpack_len_one_list(l):
-        if isinstance(l, list):
-            if len(l) == 1:
-                return l[0]
-            # If empty list, it's an empty block, so return ""
-            elif len(l) == 0:
-                return ""
-        return l
-
-    def parse_stmt(token, tokens, index):
-        subtokens = token.split()
-        statement, params = subtokens[0], subtokens[1:]
-        if statement == "if":
-            params = parse([EXPRESSION_START + " ".join(params) + EXPRESSION_END])
-            params = unpack_len_one_list(params)
-            next_else_ = tokens[index:].index(STATEMENT_START + " else " + STATEMENT_END)
-            next_else = find_next_else(tokens, index+1)
-            conseq = tokens[index+1:next_else]
-            conseq = parse(conseq)
-            conseq = unpack_len_one_list(conseq)
-            next_endif = find_next_endif(tokens, index+1)
-            alt = tokens[next_else+1:next_endif]
-            alt = parse(alt)
-            alt = unpack_len_one_list(alt)
-            index = next_endif
-            return index, tuple([statement, params, conseq, alt])
-        elif statement == "for":
-            next_endfor = tokens[index:].index(STATEMENT_START + " endfor " + STATEMENT_END)
-            conseq = tokens[index+1:index+next_endfor]
-            conseq = parse(conseq)
-            conseq = unpack_len_one_list(conseq)
-            index += next_endfor
-            return index, tuple([statement, params, conseq])
-        elif statement == "block":
-            next_endblock = tokens[index:].index(STATEMENT_START + " endblock " + STATEMENT_END)
-            block_content = tokens[index+1:index+next_endblock]
-            block_content = parse(block_content)
-            block_content = unpack_len_one_list(block_content)
-            params = unpack_len_one_list(params)
-            index += next_endblock
-            return index, tuple([statement, params, block_content])
-        return index, tuple([statement, tuple(params)])
-
-    index = 0
-    while index < len(tokens):
-        token = tokens[index]
+    stack = []
+    branch = parsed
+    end_tags = _GLOBAL_ENV['end_tags']
+    closing = dict((end_tag, statement) for statement, end_tag in end_tags.items())
+    # The line of the token, counted only when the offsets are given
+    line = 1
+
+    for position, token in enumerate(tokens):
+        if type(token) == tuple:
+            offset, token = token
+            location = 'line %d, offset %d' % (line, offset)
+            line += token.count('\n')
+        else:
+            offset, location = None, 'token %d' % position
         if is_expr(token):
             # Remove start and end tokens
             token = token[len(EXPRESSION_START):-len(EXPRESSION_END)]
-            parsed.append(parse_expr(token, tokens, index))
+            exp = parse_expression(token)
+            exp.position, exp.template = position, template
+            branch.append(exp)
         elif is_stmt(token):
             # Remove start and end tokens
-            token = token[len(STATEMENT_START):-len(STATEMENT_END)]
-            index, parsed_token = parse_stmt(token, tokens, index)
-            parsed.append(parsed_token)
+            subtokens = token[len(STATEMENT_START):-len(STATEMENT_END)].split()
+            if not subtokens:
+                raise TemplateSyntaxError("Empty statement at %s" % location, position, offset)
+            statement, params = subtokens[0], subtokens[1:]
+            if statement in end_tags:
+                branch = []
+                stack.append([statement, params, position, [branch], location, offset])
+            elif statement == "else":
+                if not stack or stack[-1][0] != "if" or len(stack[-1][3]) != 1:
+                    raise TemplateSyntaxError("Unexpected %s at %s" % (token, location), position, offset)
+                branch = []
+                stack[-1][3].append(branch)
+            elif statement in closing:
+                if not stack or stack[-1][0] != closing[statement]:
+                    message = "Unexpected %s at %s" % (token, location)
+                    if stack:
+                        message += ", {%% %s %%} opened at %s is still open" % (stack[-1][0], stack[-1][4])
+                    raise TemplateSyntaxError(message, position, offset)
+                statement, params, opened, branches, opened_location, opened_offset = stack.pop()
+                branch = stack[-1][3][-1] if stack else parsed
+                try:
+                    branch.append(make_statement(statement, params, branches, opened, template, opened_location))
+                except TemplateSyntaxError as e:
+                    e.offset = opened_offset
+                    raise
+            else:
+                branch.append(Statement([statement, tuple(params)], position, template))
         else: # Must be a string constant, just append it
-            parsed.append(token)
-        index += 1
+            branch.append(token)
+        if parsed:
+            for node in parsed:
+                yield node
+            del parsed[:]
+
+    if stack:
+        statement, _, position, _, location, offset = stack[-1]
+        raise TemplateSyntaxError("Unclosed {%% %s %%} opened at %s" % (statement, location), position, offset)
 
-    return parsed
+def is_blank(parsed_token):
+    return type(parsed_token) == str and parsed_token.strip() == ''
+
+def find_blocks(parsed_template, blocks=None):
+    """ Return the content of all the blocks of the parsed template, by name. Blocks can be nested anywhere.
+
+    >>> sorted(find_blocks([('block', 'title', 'Hello'), ('if', ('age', '>=', 18), ('block', 'adult', ['Hi ', ('block', 'name', ('name',))]), '')]).items())
+    [('adult', ['Hi ', ('block', 'name', ('name',))]), ('name', ('name',)), ('title', 'Hello')]
+    """
+    blocks = {} if blocks is None else blocks
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            find_blocks(elem, blocks)
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            if elem[0] == 'block' and elem[1] not in blocks:
+                blocks[elem[1]] = elem[2]
+            for param in elem[1:]:
+                if isinstance(param, (list, tuple)):
+                    find_blocks(param, blocks)
+    return blocks
+
+def substitute_blocks(parsed_template, blocks):
+    """ Replace the content of the blocks of the parsed template by the one given for their name, if any.
+
+    >>> substitute_blocks(['<h1>', ('block', 'title', 'Hello'), '</h1>', ('for', ['friend', 'in', 'friends'], ('block', 'friend', ('friend',)))], {'title': 'Bye', 'friend': ['Dear ', ('friend',)]})
+    ['<h1>', ('block', 'title', 'Bye'), '</h1>', ('for', ['friend', 'in', 'friends'], ('block', 'friend', ['Dear ', ('friend',)]))]
+    """
+    def substitute(elem):
+        if type(elem) == list:
+            return [substitute(sub_elem) for sub_elem in elem]
+        if isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            if elem[0] == 'block' and elem[1] in blocks:
+                # Blocks nested in the new content can be substituted too
+                return rebuild_statement(elem, ('block', elem[1], substitute(blocks[elem[1]])))
+            return rebuild_statement(elem, [elem[0]] + [substitute(param) if isinstance(param, (list, tuple)) else param for param in elem[1:]])
+        return elem
+    return substitute(parsed_template)
+
+def find_extends(parsed_template):
+    """ Return the name of the parent template, or None. Only blank text can come before extends.
+
+    >>> find_extends(['\\n', ('extends', ('base.tmpl',)), ('block', 'greeting', 'Hello there!')])
+    'base.tmpl'
+    >>> find_extends([('block', 'greeting', 'Hello there!')]) is None
+    True
+    >>> try:
+    ...     find_extends(['Hello', ('extends', ('base.tmpl',))])
+    ... except TemplateSyntaxError as e:
+    ...     print(e)
+    extends must be the first statement of the template
+    """
+    extends = [elem for elem in parsed_template if isinstance(elem, tuple) and elem[0] == 'extends']
+    if not extends:
+        return None
+    first = [elem for elem in parsed_template if not is_blank(elem)][0]
+    if len(extends) > 1 or first is not extends[0]:
+        raise TemplateSyntaxError("extends must be the first statement of the template")
+    return first[1][0]
+
+def resolve_inheritance(parsed_template, environment=None):
+    """ Flatten a template extending another one: the parent template, with the blocks overridden by the child.
+    The parent is loaded from the environment, its own inheritance is already resolved.
+
+    >>> resolve_inheritance([('extends', ('base.tmpl',)), ('block', 'greeting', 'Hello there!')])
+    [('block', 'greeting', 'Hello there!')]
+    >>> resolve_inheritance(['Hello ', ('name',)])
+    ['Hello ', ('name',)]
+    """
+    parent = find_extends(parsed_template)
+    if parent is None:
+        return parsed_template
+    environment = _GLOBAL_ENV['environment'] if environment is None else environment
+    parent_template = environment.get_template(parent).parse()
+    return substitute_blocks(parent_template, find_blocks(parsed_template))
 
 
 def is_parsed_token_a_statement(parsed_token):
@@ -315,6 +723,10 @@ def is_parsed_token_a_statement(parsed_token):
 def is_parsed_token_an_expression(parsed_token):
     return not is_parsed_token_a_statement(parsed_token)
 
+def is_expression(elem):
+    """ Expressions are parsed to Expression, but parsed templates written by hand can also hold tuples. """
+    return type(elem) == Expression or (isinstance(elem, tuple) and is_parsed_token_an_expression(elem))
+
 def eval_expression(exp, data_model):
     """
     For the purpose of simplicity, we won't handle nested expressions. Only simple bunary and unary expressions.
@@ -332,28 +744,177 @@ def eval_expression(exp, data_model):
     9.0
     >>> eval_expression(('age', '>=', 18,), data)
     True
+    >>> eval_expression(('name', '==', '"Eva"'), data)
+    True
     """
-    # First step, replace variables by their values:
-    exp = [data_model[elem] if elem in data_model else elem for elem in exp]
-    if len(exp) == 3:
-        # Binary operation
-        left_hand = exp[0]
-        op = exp[1]
-        right_hand = exp[2]
-        if op not in _GLOBAL_ENV['operators']['binary']:
-            raise ValueError("Unknown binary operator: %s" % op)
-        op = _GLOBAL_ENV['operators']['binary'][op]
-        exp = [op(left_hand, right_hand)]
-    elif len(exp) == 2:
-        # Unary operation
-        op = exp[0]
-        right_hand = exp[1]
-        if op not in _GLOBAL_ENV['operators']['unary']:
-            raise ValueError("Unknown unary operator: %s" % op)
-        op = _GLOBAL_ENV['operators']['binary'][op]
-        exp = [op(right_hand)]
-    
-    return exp[0]
+    if type(exp) != Expression:
+        exp = Expression(exp)
+    return exp.evaluate(data_model)
+
+def wrap_body(body):
+    """
+    The parser unpacks one element bodies, so a statement body can be a string constant, a single parsed token or a list.
+    Always give back something eval_ can iterate over.
+
+    >>> wrap_body(('name',))
+    [('name',)]
+    >>> wrap_body(['Hello ', ('name',)])
+    ['Hello ', ('name',)]
+    """
+    if type(body) == list:
+        return body
+    return [body]
+
+class Context(object):
+    """ The variables visible while rendering: the variables of a scope, layered over those of its parent scope.
+    The root of the scope chain is the data model, which is never modified.
+
+    >>> data = {"name": "Eva", "friend": "Billy"}
+    >>> context = Context({"friend": "John"}, data)
+    >>> context["friend"], context["name"], data["friend"]
+    ('John', 'Eva', 'Billy')
+    >>> "name" in context, "age" in context
+    (True, False)
+    >>> context.get("age", 23)
+    23
+    """
+    __slots__ = ('variables', 'parent')
+
+    def __init__(self, variables, parent):
+        self.variables = variables
+        self.parent = parent
+
+    def __contains__(self, name):
+        return name in self.variables or name in self.parent
+
+    def __getitem__(self, name):
+        variables = self.variables
+        if name in variables:
+            return variables[name]
+        return self.parent[name]
+
+    def get(self, name, default=None):
+        variables = self.variables
+        if name in variables:
+            return variables[name]
+        return self.parent.get(name, default)
+
+class RecordingMapping(object):
+    """ A data model recording the names of the variables read from it, including those it does not hold.
+
+    >>> data = RecordingMapping({"name": "Eva", "age": 23})
+    >>> data["name"], data.get("friends", []), "age" in data
+    ('Eva', [], True)
+    >>> sorted(data.names)
+    ['age', 'friends', 'name']
+    """
+    __slots__ = ('data_model', 'names')
+
+    def __init__(self, data_model):
+        self.data_model = data_model
+        self.names = set()
+
+    def __contains__(self, name):
+        self.names.add(name)
+        return name in self.data_model
+
+    def __getitem__(self, name):
+        self.names.add(name)
+        return self.data_model[name]
+
+    def get(self, name, default=None):
+        self.names.add(name)
+        return self.data_model.get(name, default)
+
+def is_loop_invariant(elem, elem_name):
+    """ Is this parsed token of a loop body worth evaluating only once, as it does not depend on the loop variable ?
+
+    >>> is_loop_invariant(('if', ('age', '>=', 18), 'adult', ''), 'friend')
+    True
+    >>> is_loop_invariant(('if', ('friend', '==', 'Billy'), 'Billy', ''), 'friend')
+    False
+    """
+    if not isinstance(elem, (list, tuple, Expression)):
+        return False
+    variables = free_variables(elem)
+    return variables is not None and elem_name not in variables
+
+def loop_fields(parsed_template, name):
+    """ Return the set of the fields of the loop variable name the loop body reads, like total for row.total,
+    or None if it reads the variable itself, or if it cannot be known.
+
+    >>> sorted(loop_fields([('row.name',), ': ', ('if', ('row.total', '>', 10), 'big', 'small')], 'row'))
+    ['name', 'total']
+    >>> loop_fields([('row',), ('row.name',)], 'row') is None
+    True
+    """
+    fields = set()
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            elem_fields = loop_fields(elem, name)
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            if elem[0] == 'if':
+                elem_fields = loop_fields([elem[1], elem[2], elem[3]], name)
+            elif elem[0] == 'for':
+                if len(elem[1]) != 3 or elem[1][2] == name:
+                    return None
+                # The variable of the nested loop hides the one of the outer loop
+                elem_fields = set() if elem[1][0] == name else loop_fields(elem[2], name)
+            elif elem[0] == 'block':
+                elem_fields = loop_fields(elem[2], name)
+            elif elem[0] == 'cache':
+                elem_fields = loop_fields([elem[1][0], elem[2]], name)
+            else:
+                return None
+        elif is_expression(elem):
+            elem_fields = set()
+            for is_variable, value in (elem if type(elem) == Expression else Expression(elem)).operands:
+                variable, path = split_variable(value) if is_variable else (None, ())
+                if variable == name:
+                    if not path:
+                        return None
+                    elem_fields.add(path[0])
+        else:
+            continue
+        if elem_fields is None:
+            return None
+        fields |= elem_fields
+    return fields
+
+def is_interpolation(parsed_template):
+    """ Is this loop body only string constants, expressions, and if statements whose branches are interpolations too ?
+    Loops over such bodies can be vectorized, see CodeGenerator.vectorized_loop.
+
+    >>> is_interpolation(['Name: ', ('row.name',), ('if', ('row.total', '>', 10), ' big', ['small ', ('row.total',)])])
+    True
+    >>> is_interpolation(['Friends: ', ('for', ['friend', 'in', 'friends'], ('friend',))])
+    False
+    """
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            if not is_interpolation(elem):
+                return False
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            if elem[0] != 'if' or not is_interpolation(elem[2]) or not is_interpolation(elem[3]):
+                return False
+        elif not (type(elem) == str or type(elem) == int or is_expression(elem)):
+            return False
+    return True
+
+def column(columns, field):
+    """ Return a column of a dict of columns as a list, converting arrays like those of NumPy to Python values. """
+    values = columns[field]
+    return values.tolist() if hasattr(values, 'tolist') else values
+
+def iter_columns(columns, fields):
+    """ Yield the rows of a dict of columns, as dicts of the given fields.
+
+    >>> list(iter_columns({'name': ['Eva', 'Billy'], 'age': [23, 31]}, ['name']))
+    [{'name': 'Eva'}, {'name': 'Billy'}]
+    """
+    fields = list(fields)
+    for values in zip(*[column(columns, field) for field in fields]):
+        yield dict(zip(fields, values))
 
 def eval_if_statement(*params, **kparams):
     cond = params[0]
@@ -361,10 +922,8 @@ def eval_if_statement(*params, **kparams):
     alt = params[2]
     data_model = {} if 'data_model' not in kparams else kparams['data_model']
     cond = eval_expression(cond, data_model)
-    if cond:
-        return eval_(conseq, data_model)
-    else:
-        return eval_(alt, data_model)
+    for chunk in generate_(wrap_body(conseq if cond else alt), data_model):
+        yield chunk
 
 _GLOBAL_ENV['statements']['if'] = eval_if_statement
 
@@ -374,31 +933,43 @@ def eval_for_statement(*params, **kparams):
         raise ValueError("Unknown for clause: %s " % str(for_))
     loop = params[1]
     data_model = {} if 'data_model' not in kparams else kparams['data_model']
-    result = []
+    loop = wrap_body(loop)
     elem_name = for_[0]
-    elem_name_present_in_data_model = elem_name in data_model
-    if elem_name_present_in_data_model:
-        old_elem_in_data_model = data_model[elem_name]
-    for elem in data_model[for_[2]]:
-        data_model[elem_name] = elem
-        result.append(eval_(loop, data_model))
-    if elem_name_present_in_data_model:
-        data_model[elem_name] = old_elem_in_data_model
-    else:
-        del data_model[elem_name]
-        
-    return ''.join(result)
+    elements = data_model[for_[2]]
+    if isinstance(elements, dict):
+        # A dict of columns, when the body reads fields of the loop variable
+        fields = loop_fields(loop, elem_name)
+        if fields:
+            elements = iter_columns(elements, fields)
+    # The loop variable lives in its own scope, the data model is never modified
+    loop_variables = {}
+    scope = Context(loop_variables, data_model)
+    # The parts of the body which do not depend on the loop variable are evaluated on the first iteration only
+    invariants = [is_loop_invariant(elem, elem_name) for elem in loop]
+    if not any(invariants):
+        for elem in elements:
+            loop_variables[elem_name] = elem
+            for chunk in generate_(loop, scope):
+                yield chunk
+        return
+    evaluated = {}
+    for elem in elements:
+        loop_variables[elem_name] = elem
+        for index, loop_elem in enumerate(loop):
+            if not invariants[index]:
+                for chunk in generate_([loop_elem], scope):
+                    yield chunk
+                continue
+            if index not in evaluated:
+                evaluated[index] = "".join(generate_([loop_elem], scope))
+            yield evaluated[index]
 
 _GLOBAL_ENV['statements']['for'] = eval_for_statement
 
 def eval_extends_statement(*params, **kparams):
     """
-    @TODO throw exception if extends is not the first statement in the template
+    Nothing to do, resolve_inheritance has already replaced the template by its parent when it is evaluated.
     """
-    parent = params[0][0]
-    parent_template = Template(open(parent, 'r')).parse()
-    print parent_template
-    data_model = {} if 'data_model' not in kparams else kparams['data_model']
     return ""
 
 _GLOBAL_ENV['statements']['extends'] = eval_extends_statement
@@ -407,13 +978,83 @@ def eval_block_statement(*params, **kparams):
     block_name = params[0]
     block_content = params[1]
     data_model = {} if 'data_model' not in kparams else kparams['data_model']
-    global_blocks = _GLOBAL_ENV['blocks']
-    if block_name not in global_blocks:
-        global_blocks[block_name] = block_content
-    return eval_(block_content, data_model)
+    for chunk in generate_(wrap_body(block_content), data_model):
+        yield chunk
 
 _GLOBAL_ENV['statements']['block'] = eval_block_statement
 
+def fragment_id(body):
+    """ Identify the body of a cache statement, once its template is resolved: the blocks it holds can be overridden,
+    by each template extending its template, and templates built from strings have no name.
+
+    >>> fragment_id(['Hello ', ('name',)]) == fragment_id(['Hello ', ('name',)]), fragment_id('one') == fragment_id('two')
+    (True, False)
+    """
+    # Imported on first use, like in file_hash
+    import hashlib
+    return hashlib.sha1(repr(body).encode('utf-8')).hexdigest()
+
+def params_fragment_id(params, body):
+    """ Return the fragment_id of the body of a cache statement, computed when it was built, see CacheParams.
+    Parsed templates written by hand have plain tuples as parameters, their body is identified each time. """
+    return getattr(params, 'fragment_id', None) or fragment_id(body)
+
+def fragment_key(params, body, data_model):
+    """ Return the key of the output of a cache statement in the fragment cache: its body, its key expression, and its value. """
+    key = params[0]
+    if type(key) != Expression:
+        key = Expression(key)
+    return (params_fragment_id(params, body), key.tokens, key.evaluate(data_model))
+
+def eval_cache_statement(*params, **kparams):
+    """
+    The output of the body is kept in _GLOBAL_ENV['fragment_cache'], and reused as long as the key has the same value.
+
+    >>> _GLOBAL_ENV['fragment_cache'].clear()
+    >>> parsed = parse(tokenize('{% cache "friends" + name 60 %}{% for friend in friends %}{{ friend }} {% endfor %}{% endcache %}'))
+    >>> eval_(parsed, {"name": "Eva", "friends": ["Billy", "John"]})
+    'Billy John '
+    >>> eval_(parsed, {"name": "Eva", "friends": ["Emily"]})
+    'Billy John '
+    >>> eval_(parsed, {"name": "Billy", "friends": ["Emily"]})
+    'Emily '
+    >>> _GLOBAL_ENV['fragment_cache'].hits, _GLOBAL_ENV['fragment_cache'].misses
+    (1, 2)
+
+    The body is identified once, when parsed, not on each render, see CacheParams:
+    >>> parsed[0][1].fragment_id == fragment_id(parsed[0][2])
+    True
+
+    Templates with the same key never share their output, even those without a name, or extending the same template:
+    >>> eval_(parse(tokenize('{% cache "k" %}one{% endcache %}'))), eval_(parse(tokenize('{% cache "k" %}two{% endcache %}')))
+    ('one', 'two')
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> for name, source in [('page.tmpl', '{% cache "page" %}<main>{% block content %}{% endblock %}</main>{% endcache %}'),
+    ...                      ('a.tmpl', '{% extends page.tmpl %}{% block content %}A{% endblock %}'),
+    ...                      ('b.tmpl', '{% extends page.tmpl %}{% block content %}B{% endblock %}')]:
+    ...     with open(os.path.join(directory, name), 'w') as f:
+    ...         _ = f.write(source)
+    >>> for compiled in (True, False):
+    ...     environment = Environment([directory], compiled=compiled)
+    ...     print(environment.get_template('a.tmpl').render() + environment.get_template('b.tmpl').render())
+    <main>A</main><main>B</main>
+    <main>A</main><main>B</main>
+    >>> shutil.rmtree(directory)
+    """
+    params, body = params
+    ttl = params[1]
+    data_model = {} if 'data_model' not in kparams else kparams['data_model']
+    cache = _GLOBAL_ENV['fragment_cache']
+    cache_key = fragment_key(params, body, data_model)
+    output = cache.get(cache_key, _MISSING)
+    if output is _MISSING:
+        output = "".join(generate_(wrap_body(body), data_model))
+        cache.set(cache_key, output, ttl)
+    return output
+
+_GLOBAL_ENV['statements']['cache'] = eval_cache_statement
+
 def eval_statement(stmt, data_model):
     """
     >>> data = {"age": 23, "friends": ["Billy", "John", "Emily"]}
@@ -421,7 +1062,7 @@ def eval_statement(stmt, data_model):
     3
     """
     # First step, replace variables by their values:
-    stmt = [data_model[elem] if type(elem) != list and elem in data_model else elem for elem in stmt]
+    stmt = [data_model[elem] if not isinstance(elem, (list, tuple, Expression)) and elem in data_model else elem for elem in stmt]
     procedure = _GLOBAL_ENV['statements'][stmt[0]]
     return procedure(*stmt[1:], data_model=data_model)
 
@@ -474,50 +1115,1980 @@ def eval_(parsed_template, data_model=None):
     >>> eval_([('extends', ('base.tmpl',)), ('block', 'greeting', 'Hello there!')])
     'Hello there!'
 
+    """
+    return "".join(generate_(resolve_inheritance(parsed_template), data_model))
+
+def generate_(parsed_template, data_model=None):
+    """ Like eval_, but yields the output chunk by chunk, as it is produced.
+
+    >>> data = {"friends": ["Billy", "John"]}
+    >>> chunks = generate_(['Call ', ('for', ['friend', 'in', 'friends'], [('friend',), ', ']), 'to help us eat.'], data)
+    >>> next(chunks)
+    'Call '
+    >>> list(chunks)
+    ['Billy', ', ', 'John', ', ', 'to help us eat.']
     """
     data_model = {} if data_model is None else data_model
-    evaluated = []
     for elem in parsed_template:
         if type(elem) == list:
-            evaluated_element = eval_(elem, data_model)
+            for chunk in generate_(elem, data_model):
+                yield chunk
         elif type(elem) == str or type(elem) == int:
-            evaluated_element = elem
-        elif type(elem) == tuple and is_parsed_token_a_statement(elem):
+            yield str(elem)
+        elif type(elem) == Expression:
+            yield str(elem.evaluate(data_model))
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
             evaluated_element = eval_statement(elem, data_model)
-        elif type(elem) == tuple and is_parsed_token_an_expression(elem):
-            evaluated_element = str(eval_expression(elem, data_model))
+            if isinstance(evaluated_element, types.GeneratorType):
+                # Statements opening a block yield their output
+                for chunk in evaluated_element:
+                    yield chunk
+            else:
+                yield str(evaluated_element)
+        elif isinstance(elem, tuple) and is_parsed_token_an_expression(elem):
+            yield str(eval_expression(elem, data_model))
         else:
             raise Exception("Cannot evaluate parsed token, unknown type: %s" % str(elem))
-            
-        evaluated.append(evaluated_element)
-        
-    return "".join(evaluated)
+
+def generate_file(path, data_model=None, environment=None):
+    """ Like generate_, for a template file too large to be read: it is memory-mapped, then tokenized, parsed and evaluated
+    as it is read. Only the top level statement being rendered is held in memory, so memory does not grow with the file.
+    A template extending another one is parsed whole before being rendered, as its blocks can come in any order.
+
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'big.tmpl')
+    >>> with open(path, 'w') as f:
+    ...     _ = f.write('{% for friend in friends %}{{ friend }}, {% endfor %}and you\\n' * 1000)
+    >>> chunks = generate_file(path, {"friends": ["Billy", "John"]})
+    >>> next(chunks), next(chunks), next(chunks)
+    ('Billy', ', ', 'John')
+    >>> ''.join(generate_file(path, {"friends": ["Billy", "John"]})) == eval_(parse(tokenize(open(path).read())), {"friends": ["Billy", "John"]})
+    True
+    >>> with open(path, 'w') as f:
+    ...     _ = f.write('\\n\\n')
+    >>> ''.join(generate_file(path))
+    '\\n\\n'
+    >>> shutil.rmtree(directory)
+    """
+    with open(path, 'rb') as file_:
+        if os.fstat(file_.fileno()).st_size == 0:
+            # Empty files cannot be mapped
+            return
+        source = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+    tokens = iter_tokens(source)
+    try:
+        nodes = iter_parse(tokens, path)
+        # Blank text can come before extends
+        leading = []
+        for node in nodes:
+            if is_blank(node):
+                leading.append(node)
+                continue
+            if isinstance(node, tuple) and node[0] == 'extends':
+                parsed_template = resolve_inheritance(leading + [node] + list(nodes), environment)
+                for chunk in generate_(parsed_template, data_model):
+                    yield chunk
+                return
+            for chunk in generate_(leading + [node], data_model):
+                yield chunk
+            break
+        else:
+            # Only blank text
+            for chunk in generate_(leading, data_model):
+                yield chunk
+        for node in nodes:
+            for chunk in generate_([node], data_model):
+                yield chunk
+    finally:
+        # The file can only be unmapped once the tokenizer is done with it
+        tokens.close()
+        source.close()
+
+def free_variables(parsed_template):
+    """ Return the set of the variables of the data model the parsed template reads, or None if it cannot be known:
+    the statements evaluated by eval_statement get the whole data model.
+
+    >>> sorted(free_variables(['Hi ', ('name',), ('for', ['friend', 'in', 'friends'], [('friend',), ('if', ('age', '>', 18), 'adult', '')])]))
+    ['age', 'friends', 'name']
+    >>> free_variables(['You have ', ('len', 'friends'), ' friends']) is None
+    True
+    """
+    variables = set()
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            elem_variables = free_variables(elem)
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            if elem[0] == 'if':
+                elem_variables = free_variables([elem[1], elem[2], elem[3]])
+            elif elem[0] == 'for':
+                if len(elem[1]) != 3:
+                    return None
+                elem_variables = free_variables(elem[2])
+                if elem_variables is not None:
+                    elem_variables = (elem_variables - set([elem[1][0]])) | set([elem[1][2]])
+            elif elem[0] == 'block':
+                elem_variables = free_variables(elem[2])
+            elif elem[0] == 'cache':
+                elem_variables = free_variables([elem[1][0], elem[2]])
+            else:
+                return None
+        elif is_expression(elem):
+            elem_variables = set((elem if type(elem) == Expression else Expression(elem)).variables)
+        else:
+            continue
+        if elem_variables is None:
+            return None
+        variables |= elem_variables
+    return variables
+
+def fold_expression(exp):
+    """ Return the value of an expression whose operands are all literals, _MISSING if it depends on the data model.
+
+    >>> fold_expression((3, '^', 2))
+    9.0
+    >>> fold_expression(('"Hello "', '+', '"there"'))
+    'Hello there'
+    >>> fold_expression((3, '^', 'power')) is _MISSING
+    True
+    """
+    if type(exp) != Expression:
+        exp = Expression(exp)
+    if exp.variables:
+        return _MISSING
+    try:
+        return exp.evaluate({})
+    except Exception:
+        # Let it fail when rendering, as it would without optimization
+        return _MISSING
+
+def count_nodes(parsed_template):
+    """ Count the lists, string constants, expressions and statements of the parsed template.
+
+    >>> count_nodes(['You are ', ('if', ('age', '>=', 18), ['old', ' enough'], ''), '!'])
+    8
+    """
+    if type(parsed_template) == list:
+        return 1 + sum(count_nodes(elem) for elem in parsed_template)
+    elif isinstance(parsed_template, tuple) and is_parsed_token_a_statement(parsed_template):
+        count = 2 if parsed_template[0] == 'if' else 1
+        for index in _GLOBAL_ENV['bodies'].get(parsed_template[0], ()):
+            count += count_nodes(parsed_template[index])
+        return count
+    # The empty string stands for an empty body
+    return 0 if parsed_template == '' else 1
+
+def optimize_body(parsed_template):
+    """ Optimize a list of parsed tokens, or a body of a statement. Return a flat list. """
+    nodes = []
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            nodes.extend(optimize_body(elem))
+        elif type(elem) == str or type(elem) == int:
+            nodes.append(str(elem))
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            nodes.extend(optimize_statement(elem))
+        elif is_expression(elem):
+            value = fold_expression(elem)
+            nodes.append(elem if value is _MISSING else str(value))
+        else:
+            nodes.append(elem)
+
+    # Concatenate neighbouring string constants
+    merged = []
+    for node in nodes:
+        if type(node) == str:
+            if node == '':
+                continue
+            if merged and type(merged[-1]) == str:
+                merged[-1] += node
+                continue
+        merged.append(node)
+    return merged
+
+def optimize_statement(stmt):
+    """ Optimize a statement, return the list of parsed tokens replacing it. """
+    if stmt[0] == 'if':
+        cond = fold_expression(stmt[1])
+        if cond is not _MISSING:
+            return optimize_body(stmt[2] if cond else stmt[3])
+    bodies = _GLOBAL_ENV['bodies'].get(stmt[0], ())
+    return [rebuild_statement(stmt, [unpack_len_one_list(optimize_body(param)) if index in bodies else param for index, param in enumerate(stmt)])]
+
+def optimize(parsed_template):
+    """ Simplify the parsed template before evaluating it: the work done here is not done again on each render.
+     - expressions whose operands are all literals are replaced by their value
+     - if statements whose condition is constant are replaced by their branch
+     - nested lists are flattened, and neighbouring string constants concatenated
+    Return the optimized template and the number of nodes removed.
+
+    >>> optimize(['You need ', (3, '^', 2), ' apples', [', ', ('if', (2, '>', 1), ['really', [' ', ('name',)]], 'no')]])
+    (['You need 9.0 apples, really ', ('name',)], 11)
+    >>> optimize([('for', ['friend', 'in', 'friends'], [('if', ('friend', '==', 'Billy'), 'Hi', ['Hello', ' ', ('friend',)]), ', '])])
+    ([('for', ['friend', 'in', 'friends'], [('if', ('friend', '==', 'Billy'), 'Hi', ['Hello ', ('friend',)]), ', '])], 1)
+
+    The output is the same:
+    >>> parsed_template = ['You have ', ('if', (1, '<', 2), [('apple_count', '+', 1), ' apples'], 'no apples'), ' and ', (2, '*', 6), ' pears']
+    >>> eval_(optimize(parsed_template)[0], {'apple_count': 5}) == eval_(parsed_template, {'apple_count': 5})
+    True
+    """
+    optimized = optimize_body(parsed_template)
+    return optimized, count_nodes(parsed_template) - count_nodes(optimized)
+
+def substitute_static(exp, static_data):
+    """ Return the expression with its operands reading the static data replaced by their values, as literals.
+
+    >>> substitute_static(('greeting', '+', 'name'), {'greeting': 'Hello '})
+    ('"Hello "', '+', 'name')
+    >>> substitute_static(('brand.color',), {'brand': {'color': 'red'}}).evaluate({})
+    'red'
+    """
+    if type(exp) != Expression:
+        exp = Expression(exp)
+    if not any(name in static_data for name in exp.variables):
+        return exp
+    tokens = list(exp.tokens)
+    # The indexes of the operands among the tokens, see Expression
+    indexes = {3: (0, 2), 2: (1,)}.get(len(tokens), (0,))
+    for index in indexes:
+        is_variable, value = parse_operand(tokens[index])
+        name, fields = split_variable(value) if is_variable else (None, ())
+        if name not in static_data:
+            continue
+        try:
+            value = lookup_fields(static_data[name], fields, value)
+        except (KeyError, AttributeError):
+            # Kept as is, rendering raises the same error. An unrolled loop cannot keep it, see specialize_statement
+            continue
+        # Strings are quoted, any other value is a literal, see parse_operand
+        tokens[index] = '"%s"' % value if type(value) == str else value
+    return Expression(tuple(tokens), exp.position, exp.template)
+
+def specialize_body(parsed_template, static_data):
+    """ Specialize a list of parsed tokens, or a body of a statement. Return a flat list. """
+    nodes = []
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            nodes.extend(specialize_body(elem, static_data))
+        elif type(elem) == str or type(elem) == int:
+            nodes.append(elem)
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            nodes.extend(specialize_statement(elem, static_data))
+        elif is_expression(elem):
+            exp = substitute_static(elem, static_data)
+            value = fold_expression(exp)
+            nodes.append(exp if value is _MISSING else str(value))
+        else:
+            nodes.append(elem)
+    return nodes
+
+def specialize_statement(stmt, static_data):
+    """ Specialize a statement, return the list of parsed tokens replacing it. """
+    if stmt[0] == 'if':
+        cond = substitute_static(stmt[1], static_data)
+        value = fold_expression(cond)
+        if value is not _MISSING:
+            return specialize_body(stmt[2] if value else stmt[3], static_data)
+        return [rebuild_statement(stmt, ['if', cond, unpack_len_one_list(specialize_body(stmt[2], static_data)),
+                                         unpack_len_one_list(specialize_body(stmt[3], static_data))])]
+    elif stmt[0] == 'for' and len(stmt[1]) == 3 and stmt[1][1] == 'in':
+        name, iterable = stmt[1][0], stmt[1][2]
+        if iterable in static_data:
+            # Unrolled, the body is specialized for each element
+            elements = static_data[iterable]
+            if isinstance(elements, dict) and loop_fields(stmt[2], name):
+                elements = iter_columns(elements, loop_fields(stmt[2], name))
+            nodes = []
+            for element in elements:
+                scope = dict(static_data)
+                scope[name] = element
+                nodes.extend(specialize_body(stmt[2], scope))
+            variables = free_variables(nodes)
+            # The loop variable is gone once unrolled: if the body still reads it, e.g. a field missing from an element, the loop is kept
+            if variables is not None and name not in variables:
+                return nodes
+        if name in static_data:
+            # The loop variable hides the static data of the same name
+            static_data = dict(static_data)
+            del static_data[name]
+        return [rebuild_statement(stmt, ['for', stmt[1], unpack_len_one_list(specialize_body(stmt[2], static_data))])]
+    elif stmt[0] == 'block':
+        return [rebuild_statement(stmt, ['block', stmt[1], unpack_len_one_list(specialize_body(stmt[2], static_data))])]
+    elif stmt[0] == 'cache':
+        (key, ttl), body = stmt[1:]
+        return [rebuild_statement(stmt, ['cache', (substitute_static(key, static_data), ttl), unpack_len_one_list(specialize_body(body, static_data))])]
+    # The other statements get the whole data model when rendered, what they read cannot be known
+    return [stmt]
+
+def specialize(parsed_template, static_data):
+    """ Partially evaluate the parsed template, for the variables of the static data: expressions reading only them
+    are replaced by their value, if statements by their branch, and for loops over them are unrolled.
+    Return the residual template, reading only the other variables. It gives the same output for data models
+    holding the static data, as long as its statements other than if, for, block and cache read none of it.
+
+    >>> parsed_template = parse(tokenize('{% if beta %}New! {% endif %}{% for lang in langs %}{{ lang }}: {{ greeting + name }} {% endfor %}'))
+    >>> residual = specialize(parsed_template, {'beta': True, 'langs': ['en', 'fr'], 'greeting': 'Hello '})
+    >>> residual
+    ['New! ', 'en', ': ', ('"Hello "', '+', 'name'), ' ', 'fr', ': ', ('"Hello "', '+', 'name'), ' ']
+    >>> eval_(residual, {'name': 'Eva'})
+    'New! en: Hello Eva fr: Hello Eva '
+
+    A loop whose body cannot be specialized for all its elements is not unrolled, it renders as the template does:
+    >>> parsed_template = parse(tokenize('{% for row in rows %}[{{ row.total }}]{% endfor %}'))
+    >>> specialize(parsed_template, {'rows': [{'total': 1}, {}]})
+    [('for', ['row', 'in', 'rows'], ['[', ('row.total',), ']'])]
+    """
+    return specialize_body(parsed_template, static_data)
+
+
+# The rows a vectorized loop formats and outputs at once, see CodeGenerator.vectorized_loop
+VECTORIZED_ROWS = 1000
+
+
+class CodeGenerator(object):
+    """ Turns a parsed template into the source code of a Python function.
+
+    The generated function does, once and for all, the work eval_ repeats on every render:
+    dispatching on the type of each parsed token, looking up statements and operators by name.
+    Statements are compiled by the functions registered in _GLOBAL_ENV['compilers'],
+    the others are handed over to eval_statement at render time.
+
+    The generated code defines two functions: generate yields the output chunk by chunk, render joins it.
+    >>> print(CodeGenerator().generate(['Hello ', ('name',), '!']))
+    def generate(data_model=None):
+        _d = {} if data_model is None else data_model
+        yield 'Hello '
+        yield str(_d.get('name', 'name'))
+        yield '!'
+    def render(data_model=None):
+        return ''.join(generate(data_model))
+    """
+
+    def __init__(self, hoisting=True, profiling=False, vectorized=True, encoding=None):
+        if profiling and encoding is not None:
+            raise ValueError("Profiled functions cannot write bytes")
+        self.lines = []
+        self.indentation = 1
+        self.namespace = {'_eval_statement': eval_statement, '_Context': Context, '_GeneratorType': types.GeneratorType, '_MISSING': _MISSING, '_GLOBAL_ENV': _GLOBAL_ENV,
+                          '_lookup_fields': lookup_fields, '_column': column, '_iter_columns': iter_columns}
+        # The descriptions of the constants added to the namespace, by name
+        self.constants = {}
+        self.counter = 0
+        self.yields = False
+        # Where the output goes: None to yield it, or the source of a function to call with it
+        self.target = None
+        # The loop variables in scope, by name, with the name of the Python local holding them
+        self.scope = {}
+        # The loops being compiled, innermost last, see enter_loop
+        self.loops = []
+        self.hoisting = hoisting
+        # Python locals memoizing values which do not change during a render, by key
+        self.memos = {}
+        self.render_memos = []
+        # Instrument statements and expressions for a Profiler, see profiled_node
+        self.profiling = profiling
+        self.vectorized = vectorized
+        # The loop variables read as columns, see vectorized_loop: by name, the local holding each field
+        self.columns = {}
+        # Given an encoding, generate a write function instead, passing the encoded output to a function, see generate
+        self.writer = encoding is not None
+        # Python 2 strings are already bytes
+        self.encoding = encoding if str is not bytes else None
+        if self.writer:
+            self.target = '_w'
+
+    def write(self, line):
+        self.lines.append('    ' * self.indentation + line)
+
+    def indent(self):
+        self.indentation += 1
+
+    def dedent(self):
+        self.indentation -= 1
+
+    def temporary(self, prefix='t'):
+        self.counter += 1
+        return '_%s%d' % (prefix, self.counter)
+
+    def constant(self, value, description=None):
+        """ Bind a Python object in the namespace of the generated function, return its name.
+        The description tells how to bind it again when the code is loaded from a precompiled template, see load_constant. """
+        name = self.temporary('c')
+        self.namespace[name] = value
+        self.constants[name] = ('value', value) if description is None else description
+        return name
+
+    def output_constant(self, text):
+        """ Output a string constant, encoded once and for all when writing bytes. """
+        if self.encoding is not None:
+            self.write('%s(%r)' % (self.target, text.encode(self.encoding)))
+        else:
+            self.output(repr(text))
+
+    def output(self, source, encoded=False):
+        """ Output the value of a Python expression, which must be a string, or bytes if encoded. """
+        if self.encoding is not None and not encoded:
+            source = '(%s).encode(%r)' % (source, self.encoding)
+        if self.target is None and self.profiling:
+            # Count the output size, the output of a hoisted value counts when it is yielded
+            self.write('_v = %s' % source)
+            self.write('_o += len(_v)')
+            # The time the consumer takes until the next chunk is not spent by the template, see profiled_node
+            self.write('_t = _timer()')
+            self.write('yield _v')
+            self.write('_y += _timer() - _t')
+            self.yields = True
+        elif self.target is None:
+            self.write('yield %s' % source)
+            self.yields = True
+        else:
+            self.write('%s(%s)' % (self.target, source))
+
+    def enter_loop(self, name, local):
+        """ Bring the loop variable in scope. To be called right after the for line, before its body. """
+        loop = {
+            'name': name,
+            'local': local,
+            'scope': self.scope,
+            # Where the body starts, to reset the memos of the loop on each iteration
+            'start': len(self.lines),
+            'indentation': self.indentation + 1,
+            'memos': [],
+        }
+        self.loops.append(loop)
+        self.scope = dict(self.scope)
+        self.scope[name] = local
+
+    def exit_loop(self):
+        loop = self.loops.pop()
+        self.scope = loop['scope']
+        resets = ['    ' * loop['indentation'] + '%s = _MISSING' % memo for memo in loop['memos']]
+        self.lines[loop['start']:loop['start']] = resets
+
+    def loop_owner(self, variables):
+        """ Return the innermost loop whose variable is in variables, or None if they do not depend on any loop. """
+        for loop in reversed(self.loops):
+            if loop['name'] in variables:
+                return loop
+        return None
+
+    def hoistable(self, elem):
+        """ Return the loop owning the value of elem, None for the whole render, or False if it cannot be hoisted. """
+        if not self.hoisting or not self.loops:
+            return False
+        variables = free_variables(elem)
+        if variables is None:
+            return False
+        owner = self.loop_owner(variables)
+        if owner is self.loops[-1]:
+            # It changes on each iteration of the innermost loop, nothing to gain
+            return False
+        return owner
+
+    def memo(self, owner, key):
+        """ Return the name of a local memoizing a value for the render, or for each iteration of the owner loop.
+        The same key gives the same local, so a value is computed only once however many times it is used. """
+        key = (None if owner is None else owner['local'], key)
+        if key not in self.memos:
+            self.memos[key] = self.temporary('m')
+            memos = self.render_memos if owner is None else owner['memos']
+            memos.append(self.memos[key])
+        return self.memos[key]
+
+    def memoized(self, owner, key, compute):
+        """ Write the code computing the value of the memo only the first time, return the memo. """
+        local = self.memo(owner, key)
+        self.write('if %s is _MISSING:' % local)
+        self.indent()
+        compute(local)
+        self.dedent()
+        return local
+
+    def hoisted_expression(self, exp):
+        """ Like expression, but computed only once per render, or per iteration of the loop it depends on. """
+        owner = self.hoistable(exp)
+        if owner is False:
+            return self.expression(exp)
+        return self.memoized(owner, ('value', repr(exp)), lambda local: self.write('%s = %s' % (local, self.expression(exp))))
+
+    def hoisted_node(self, elem):
+        """ Output a statement or an expression computed only once per render, or per iteration of the loop it depends on.
+        Return False if it cannot be hoisted. """
+        owner = self.hoistable(elem)
+        if owner is False:
+            return False
+        def compute(local):
+            if is_expression(elem):
+                self.write('%s = str(%s)' % (local, self.expression(elem)))
+            else:
+                self.buffered(local, lambda: self.statement(elem))
+            if self.encoding is not None:
+                # Encoded once too
+                self.write('%s = %s.encode(%r)' % (local, local, self.encoding))
+        # Encoded or not, depending on where it is output
+        self.output(self.memoized(owner, ('output', self.encoding, repr(elem)), compute), encoded=True)
+        return True
+
+    def buffered(self, local, compile_output):
+        """ Write the code storing the output of compile_output in a local, instead of outputting it. """
+        buffer = self.temporary('b')
+        self.write('%s = []' % buffer)
+        # The local holds a string, encoded when it is output
+        target, self.target = self.target, buffer + '.append'
+        encoding, self.encoding = self.encoding, None
+        compile_output()
+        self.target = target
+        self.encoding = encoding
+        self.write("%s = ''.join(%s)" % (local, buffer))
+
+    def context(self):
+        """ Return the Python source of the mapping of the variables visible at this point, for eval_statement. """
+        if not self.scope:
+            return '_d'
+        variables = ', '.join('%r: %s' % (name, local) for name, local in sorted(self.scope.items()))
+        return '_Context({%s}, _d)' % variables
+
+    def variable(self, name):
+        """ Return the Python source of the value of a variable, which must exist. """
+        if name in self.scope:
+            return self.scope[name]
+        return '_d[%r]' % (name,)
+
+    def operand(self, operand):
+        """ Return the Python source of an operand, as classified by parse_operand. """
+        is_variable, value = operand
+        if not is_variable:
+            if type(value) in (str, int, float, bool) or value is None:
+                return repr(value)
+            # Any other value, set by specialize
+            return self.constant(value)
+        name, fields = split_variable(value)
+        if fields:
+            if name in self.columns:
+                # A column of a vectorized loop, see vectorized_loop
+                source = self.columns[name][fields[0]]
+                if len(fields) == 1:
+                    return source
+                return '_lookup_fields(%s, %r, %r)' % (source, fields[1:], value)
+            source = self.scope[name] if name in self.scope else '_d.get(%r, _MISSING)' % (name,)
+            return '_lookup_fields(%s, %r, %r)' % (source, fields, value)
+        if value in self.scope:
+            return self.scope[value]
+        # A variable missing from the data model stands for its own name
+        return '_d.get(%r, %r)' % (value, value)
+
+    def expression(self, exp):
+        """ Return the Python source of an expression, see Expression for the semantics. """
+        if type(exp) != Expression:
+            exp = Expression(exp)
+        operands = ', '.join([self.operand(operand) for operand in exp.operands])
+        if exp.operator is None:
+            return operands
+        # Operators are looked up again by their symbol when loaded from a precompiled template
+        if len(exp.operands) == 2:
+            description = ('operator', 'binary', exp.tokens[1])
+        else:
+            description = ('operator', 'unary', exp.tokens[0])
+        return '%s(%s)' % (self.constant(exp.operator, description), operands)
+
+    def profiled_node(self, elem):
+        """ Output a statement or an expression, recording its calls, time and output size to the profiler. """
+        key = self.constant((getattr(elem, 'template', None), getattr(elem, 'position', None), node_source(elem)))
+        start, size, paused = self.temporary('s'), self.temporary('o'), self.temporary('y')
+        self.write('%s = _timer()' % start)
+        self.write('%s = _o' % size)
+        self.write('%s = _y' % paused)
+        self.node(elem, profiled=True)
+        self.write('_p.record(%s, _timer() - %s - (_y - %s), _o - %s)' % (key, start, paused, size))
+
+    def node(self, elem, profiled=False):
+        if self.profiling and not profiled and type(elem) not in (list, str, int):
+            self.profiled_node(elem)
+        elif type(elem) == list:
+            self.body(elem)
+        elif type(elem) == str or type(elem) == int:
+            if elem != '':
+                self.output_constant(str(elem))
+        elif self.loops and self.hoisted_node(elem):
+            pass
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            self.statement(elem)
+        elif is_expression(elem):
+            self.output('str(%s)' % self.expression(elem))
+        else:
+            raise Exception("Cannot compile parsed token, unknown type: %s" % str(elem))
+
+    def statement(self, elem):
+        compiler = _GLOBAL_ENV['compilers'].get(elem[0])
+        if compiler is None:
+            self.write('_result = _eval_statement(%s, %s)' % (self.constant(elem), self.context()))
+            self.write('if isinstance(_result, _GeneratorType):')
+            self.indent()
+            self.write('for _chunk in _result:')
+            self.indent()
+            self.output('_chunk')
+            self.dedent()
+            self.dedent()
+            self.write('else:')
+            self.indent()
+            self.output('str(_result)')
+            self.dedent()
+        else:
+            compiler(self, *elem[1:])
+
+    def body(self, parsed_template):
+        for elem in wrap_body(parsed_template):
+            self.node(elem)
+
+    def block(self, parsed_template):
+        """ Generate an indented Python block, which must never be empty. """
+        self.indent()
+        self.write('pass')
+        self.body(parsed_template)
+        self.dedent()
+
+    def interpolation(self, parsed_template, name, invariants=None):
+        """ Return the Python source of the string output by a body, see is_interpolation, as a single format operation.
+        The values of the expressions not depending on the loop variable name are computed once, by the statements
+        appended to invariants, unless it is None: they could not be computed before knowing which branch is taken. """
+        formats, values = [], []
+        for elem in wrap_body(parsed_template):
+            if type(elem) == list:
+                values.append(self.interpolation(elem, name, invariants))
+            elif type(elem) == str or type(elem) == int:
+                formats.append(str(elem).replace('%', '%%'))
+                continue
+            elif is_expression(elem):
+                values.append(self.invariant(elem, name, invariants))
+            else:
+                conseq, alt = self.interpolation(elem[2], name), self.interpolation(elem[3], name)
+                values.append('(%s if %s else %s)' % (conseq, self.invariant(elem[1], name, invariants), alt))
+            formats.append('%s')
+        if not values:
+            return repr(''.join(formats) % ())
+        return '%r %% (%s,)' % (''.join(formats), ', '.join(values))
+
+    def invariant(self, exp, name, invariants):
+        """ Return the Python source of an expression, computed once beforehand if it does not depend on the loop variable. """
+        if invariants is None or not self.hoisting or name in free_variables(exp):
+            return self.expression(exp)
+        local = self.temporary('i')
+        invariants.append('%s = %s' % (local, self.expression(exp)))
+        return local
+
+    def vectorized_loop(self, for_, loop):
+        """ Output a for loop whose body is an interpolation, see is_interpolation, in bulk:
+        one format operation per element, and a single join per VECTORIZED_ROWS elements, so the output is still streamed
+        in bounded chunks. Return False if it cannot.
+        When the body reads fields of the loop variable, like row.total, and the variable is a dict, it holds columns:
+        lists, or arrays like those of NumPy. """
+        if not self.vectorized or self.profiling or not is_interpolation(loop):
+            return False
+        name, elements, element = for_[0], self.temporary('r'), self.temporary('l')
+        fields = loop_fields(loop, name)
+        self.write('%s = %s' % (elements, self.variable(for_[2])))
+        if fields:
+            fields = sorted(fields)
+            column_locals = [self.temporary('x') for field in fields]
+            self.write('if isinstance(%s, dict):' % elements)
+            self.indent()
+            self.write('%s = (%s,)' % (elements, ', '.join(['_column(%s, %r)' % (elements, field) for field in fields])))
+            # Zipped, the columns give no row if any is empty
+            self.write('if all(%s):' % elements)
+            self.indent()
+            self.columns[name] = dict(zip(fields, column_locals))
+            invariants = []
+            rows = self.interpolation(loop, name, invariants)
+            del self.columns[name]
+            for invariant in invariants:
+                self.write(invariant)
+            start, column_local = self.temporary('s'), self.temporary('x')
+            self.write('for %s in range(0, min(map(len, %s)), %d):' % (start, elements, VECTORIZED_ROWS))
+            self.indent()
+            self.output("''.join([%s for (%s,) in zip(*[%s[%s:%s + %d] for %s in %s])])"
+                        % (rows, ', '.join(column_locals), column_local, start, start, VECTORIZED_ROWS, column_local, elements))
+            self.dedent()
+            self.dedent()
+            self.dedent()
+            self.write('else:')
+            self.indent()
+        self.write('if not isinstance(%s, list):' % elements)
+        self.indent()
+        self.write('%s = list(%s)' % (elements, elements))
+        self.dedent()
+        self.write('if %s:' % elements)
+        self.indent()
+        scope, self.scope = self.scope, dict(self.scope)
+        self.scope[name] = element
+        invariants = []
+        rows = self.interpolation(loop, name, invariants)
+        self.scope = scope
+        for invariant in invariants:
+            self.write(invariant)
+        start = self.temporary('s')
+        self.write('for %s in range(0, len(%s), %d):' % (start, elements, VECTORIZED_ROWS))
+        self.indent()
+        self.output("''.join([%s for %s in %s[%s:%s + %d]])" % (rows, element, elements, start, start, VECTORIZED_ROWS))
+        self.dedent()
+        self.dedent()
+        if fields:
+            self.dedent()
+        return True
+
+    def generate(self, parsed_template):
+        self.body(parsed_template)
+        header = [
+            'def generate(data_model=None):',
+            '    _d = {} if data_model is None else data_model',
+        ]
+        footer = [
+            'def render(data_model=None):',
+            "    return ''.join(generate(data_model))",
+        ]
+        if self.profiling:
+            # The profiled variant is a separate function, the one used for rendering pays nothing for it
+            self.namespace['_Profiler'] = Profiler
+            header = [
+                'def generate(data_model=None, profiler=None):',
+                '    _d = {} if data_model is None else data_model',
+                '    _p = _Profiler() if profiler is None else profiler',
+                '    _timer = _p.timer',
+                '    _o = 0',
+                '    _y = 0',
+            ]
+            footer = [
+                'def render(data_model=None, profiler=None):',
+                "    return ''.join(generate(data_model, profiler))",
+            ]
+        if self.writer:
+            self.namespace['_BytesIO'] = io.BytesIO
+            header = [
+                'def write(_w, data_model=None):',
+                '    _d = {} if data_model is None else data_model',
+            ]
+            footer = [
+                'def render(data_model=None):',
+                '    _b = _BytesIO()',
+                '    write(_b.write, data_model)',
+                '    return _b.getvalue()',
+            ]
+        if self.render_memos:
+            header.append('    %s = _MISSING' % ' = '.join(self.render_memos))
+        if not self.yields and not self.writer:
+            # Still make it a generator
+            header.append("    if 0: yield ''")
+        return '\n'.join(header + self.lines + footer)
+
+
+def compile_if_statement(codegen, cond, conseq, alt):
+    codegen.write('if %s:' % codegen.hoisted_expression(cond))
+    codegen.block(conseq)
+    codegen.write('else:')
+    codegen.block(alt)
+
+_GLOBAL_ENV['compilers']['if'] = compile_if_statement
+
+def compile_for_statement(codegen, for_, loop):
+    if len(for_) != 3 or for_[1] != 'in':
+        raise ValueError("Unknown for clause: %s " % str(for_))
+    if codegen.vectorized_loop(for_, loop):
+        return
+    elem = codegen.temporary('l')
+    elements = codegen.variable(for_[2])
+    if loop_fields(loop, for_[0]):
+        # It can be a dict of columns
+        elements = '_iter_columns(%s, %r) if isinstance(%s, dict) else %s' % (elements, sorted(loop_fields(loop, for_[0])), elements, elements)
+    # The loop variable is a Python local, the data model is never modified
+    codegen.write('for %s in %s:' % (elem, elements))
+    codegen.enter_loop(for_[0], elem)
+    codegen.block(loop)
+    codegen.exit_loop()
+
+_GLOBAL_ENV['compilers']['for'] = compile_for_statement
+
+def compile_block_statement(codegen, block_name, block_content):
+    codegen.body(block_content)
+
+_GLOBAL_ENV['compilers']['block'] = compile_block_statement
+
+def compile_cache_statement(codegen, params, body):
+    key, ttl = params
+    if type(key) != Expression:
+        key = Expression(key)
+    cache, cache_key, output = codegen.temporary('f'), codegen.temporary('k'), codegen.temporary('v')
+    # Looked up on each render, so the cache can be replaced
+    codegen.write("%s = _GLOBAL_ENV['fragment_cache']" % cache)
+    # The same key as fragment_key
+    codegen.write('%s = (%r, %r, %s)' % (cache_key, params_fragment_id(params, body), key.tokens, codegen.expression(key)))
+    codegen.write('%s = %s.get(%s, _MISSING)' % (output, cache, cache_key))
+    codegen.write('if %s is _MISSING:' % output)
+    codegen.indent()
+    codegen.buffered(output, lambda: codegen.body(body))
+    codegen.write('%s.set(%s, %s, %r)' % (cache, cache_key, output, ttl))
+    codegen.dedent()
+    codegen.output(output)
+
+_GLOBAL_ENV['compilers']['cache'] = compile_cache_statement
+
+def compile_(parsed_template, hoisting=True, profiling=False, vectorized=True, encoding=None):
+    """ Compile the parsed template into a Python function taking the data model and returning the rendered string.
+    This is an alternative to eval_: the work of walking the AST is done once, instead of on each render.
+    The generator yielding the output chunk by chunk, the alternative to generate_, is its generate attribute.
+
+    >>> render = compile_(['Hello ', ('name',), ', you need ', (12, '-', 'apple_count'), ' more apples.'])
+    >>> render({"name": "Eva", "apple_count": 5})
+    'Hello Eva, you need 7 more apples.'
+
+    The compiled function gives the same output as eval_:
+    >>> data = {"name": "Eva", "age": 23, "apple_count": 5, "friends": ["Billy", "John", "Emily"]}
+    >>> parsed_templates = [
+    ...     [],
+    ...     ['You are ', ('if', ('age', '>=', 18), 'old enough', 'not old enough'), '!'],
+    ...     ['You are ', ('if', ('age', '>=', 18), ['old enough, ', ('name',)], ''), '!'],
+    ...     ['You are ', ('if', ('age', '<', 18), ('name',), ''), '!'],
+    ...     ['After, you can call ', ('for', ('friend', 'in', 'friends'), [('friend',), ', ']), 'to help us eat.'],
+    ...     ['You are ', ('if', ('age', '>=', 18), ['old enough and you have enough friends: ', ('for', ['friend', 'in', 'friends'], [('friend',), ', '])], 'not old enough'), '!'],
+    ...     ['Condition one ', ('if', ('age', '>=', 18), ["is true, let's loop: ", ('for', ['friend', 'in', 'friends'], ('if', ('friend', '==', 'Billy'), 'wow, Billy!', [('friend',), ', ']))], '')],
+    ...     [('block', 'greeting', ['Hello there, ', ('name',)]), ' You have ', ('len', 'friends'), ' friends.'],
+    ...     [(3, '^', 2), ' ', ('age', '>=', 18)],
+    ...     [('extends', ('base.tmpl',)), ('block', 'greeting', ['Hello ', ('name',)])],
+    ...     [('for', ['friend', 'in', 'friends'], ('cache', (('friend',), 60), ['Hello ', ('friend',), ' ']))],
+    ... ]
+    >>> [compile_(parsed)(data) for parsed in parsed_templates] == [eval_(parsed, data) for parsed in parsed_templates]
+    True
+    >>> compile_(parsed_templates[4])(data) == 'After, you can call Billy, John, Emily, to help us eat.'
+    True
+    >>> [''.join(compile_(parsed).generate(data)) for parsed in parsed_templates] == [''.join(generate_(parsed, data)) for parsed in parsed_templates]
+    True
+
+    Rendering never modifies the data model, the loop variables live in their own scope:
+    >>> data['friend'] = 'Superman'
+    >>> compile_(parsed_templates[4])(data) == eval_(parsed_templates[4], data)
+    True
+    >>> data['friend']
+    'Superman'
+
+    Values which do not depend on a loop variable are computed once per render, or once per iteration of the loop they depend on.
+    Loops whose body is only interpolation are vectorized, see CodeGenerator.vectorized_loop:
+    >>> parsed = parse(tokenize('{% for f in friends %}{% if age >= 18 %}{{ f }}{% for g in groups %}[{{ name + f }}{{ f + g }}]{% endfor %}{% endif %}{% endfor %}'))
+    >>> print(compile_(parsed).source)
+    def generate(data_model=None):
+        _d = {} if data_model is None else data_model
+        _m2 = _MISSING
+        for _l1 in _d['friends']:
+            pass
+            if _m2 is _MISSING:
+                _m2 = _c3(_d.get('age', 'age'), 18)
+            if _m2:
+                pass
+                yield str(_l1)
+                _r4 = _d['groups']
+                if not isinstance(_r4, list):
+                    _r4 = list(_r4)
+                if _r4:
+                    _i6 = _c7(_d.get('name', 'name'), _l1)
+                    for _s9 in range(0, len(_r4), 1000):
+                        yield ''.join(['[%s%s]' % (_i6, _c8(_l1, _l5),) for _l5 in _r4[_s9:_s9 + 1000]])
+            else:
+                pass
+    def render(data_model=None):
+        return ''.join(generate(data_model))
+    >>> data = {"name": "Eva", "age": 23, "friends": ["Billy", "John"], "groups": ["A", "B"]}
+    >>> compile_(parsed)(data) == compile_(parsed, hoisting=False)(data) == eval_(parsed, data)
+    True
+    >>> compile_(parsed)(data)
+    'Billy[EvaBillyBillyA][EvaBillyBillyB]John[EvaJohnJohnA][EvaJohnJohnB]'
+
+    A long vectorized loop is still output in chunks of VECTORIZED_ROWS elements, the whole output is never held at once:
+    >>> parsed = parse(tokenize('{% for row in rows %}{{ row.total }},{% endfor %}'))
+    >>> rows = [{'total': total} for total in range(2500)]
+    >>> [len(chunk) for chunk in compile_(parsed).generate({'rows': rows})]
+    [3890, 5000, 2500]
+    >>> columns = {'total': list(range(2500))}
+    >>> [len(chunk) for chunk in compile_(parsed).generate({'rows': columns})]
+    [3890, 5000, 2500]
+
+    Errors are reported when compiling instead of rendering:
+    >>> compile_([('for', ['friend', 'within', 'friends'], [('friend',), ','])])
+    Traceback (most recent call last):
+      ...
+    ValueError: Unknown for clause: ['friend', 'within', 'friends'] 
+
+    With profiling, the functions take a Profiler as second argument, see Profiler.
+
+    Given an encoding, the function returns bytes. Instead of generate, its write attribute passes the encoded
+    output chunk by chunk to a function, like the write method of a buffer. String constants are encoded once:
+    >>> render = compile_(['Hello ', ('name',), ', you need ', (12, '-', 'apple_count'), ' more apples.'], encoding='utf-8')
+    >>> render({"name": "Eva", "apple_count": 5}) == b'Hello Eva, you need 7 more apples.'
+    True
+    >>> chunks = []
+    >>> render.write(chunks.append, {"name": "Eva", "apple_count": 5})
+    >>> chunks[:2] == [b'Hello ', b'Eva']
+    True
+    """
+    codegen = CodeGenerator(hoisting, profiling, vectorized, encoding)
+    source = codegen.generate(resolve_inheritance(parsed_template))
+    render = load_code(compile(source, '<template>', 'exec'), codegen.namespace)
+    render.source = source
+    # To precompile the template, see dump_artifact
+    render.constants = codegen.constants
+    return render
+
+def load_code(code, namespace):
+    """ Run the code generated for a template in the namespace, return its render function. """
+    exec(code, namespace)
+    render = namespace['render']
+    if 'write' in namespace:
+        render.write = namespace['write']
+    else:
+        render.generate = namespace['generate']
+    render.code = code
+    return render
+
+def load_constant(description):
+    """ Return the constant of generated code, from its description, see CodeGenerator.constant. """
+    if description[0] == 'operator':
+        return Expression.lookup_operator(description[1], description[2])
+    return description[1]
+
+
+def node_source(elem):
+    """ Return the tag of a parsed statement or expression, as it could be written in the template.
+
+    >>> node_source(('if', ('age', '>=', 18), 'adult', ''))
+    '{% if age >= 18 %}'
+    >>> node_source(('for', ['friend', 'in', 'friends'], ('friend',)))
+    '{% for friend in friends %}'
+    >>> node_source(('len', 'friends')), node_source((12, '-', 'apple_count'))
+    ('{% len friends %}', '{{ 12 - apple_count }}')
+    >>> node_source(('cache', (('"friends"', '+', 'name'), 60), ('friends',)))
+    '{% cache "friends" + name 60 %}'
+    """
+    if is_expression(elem):
+        return '{{ %s }}' % ' '.join([str(token) for token in elem])
+    # The bodies of a statement are not part of its tag
+    params = elem[1:2] if elem[0] in _GLOBAL_ENV['bodies'] else elem[1:]
+    def words(param):
+        if isinstance(param, (list, tuple, Expression)):
+            return sum([words(token) for token in param], [])
+        return [] if param is None else [str(param)]
+    return '{%% %s %%}' % ' '.join([elem[0]] + words(params))
+
+class ProfiledNode(object):
+    """ What a Profiler recorded for a statement or an expression of a template. """
+    __slots__ = ('template', 'position', 'source', 'calls', 'time', 'chars')
+
+    def __init__(self, template, position, source):
+        self.template = template
+        self.position = position
+        self.source = source
+        self.calls = 0
+        self.time = 0.0
+        self.chars = 0
+
+    def __repr__(self):
+        return 'ProfiledNode(%r, %r, %r, calls=%d, time=%f, chars=%d)' % (self.template, self.position, self.source, self.calls, self.time, self.chars)
+
+class Profiler(object):
+    """ Records, over the renders it is given to, how many times each statement and expression of a template was evaluated,
+    the time it took and the size of its output, in characters. The time and size of a node include those of the nodes nested in it,
+    but not the time the consumer of a streamed render takes between chunks.
+    Nodes are identified by their template and the index of their token, see Statement.
+
+    >>> profiler = Profiler()
+    >>> template = Template(open('test.tmpl'))
+    >>> output = template.render({"name": "Eva", "age": 23, "apple_count": 5}, profiler=profiler)
+    >>> output == template.render({"name": "Eva", "age": 23, "apple_count": 5})
+    True
+    >>> [(node.template, node.position, node.source, node.calls, node.chars) for node in profiler.nodes(key='position')]
+    [('test.tmpl', 1, '{{ name }}', 1, 3), ('test.tmpl', 3, '{{ age }}', 1, 2), ('test.tmpl', 5, '{{ 12 - apple_count }}', 1, 1)]
+    >>> print(profiler.report().splitlines()[0])
+       calls    time (s)   per call (s)      chars  node
+
+    With a timer advanced only by the consumer, no time is recorded:
+    >>> clock = [0.0]
+    >>> profiler = Profiler(timer=lambda: clock[0])
+    >>> for chunk in template.generate({"name": "Eva", "age": 23, "apple_count": 5}, profiler=profiler):
+    ...     clock[0] += 1
+    >>> sum(node.time for node in profiler.nodes())
+    0.0
+
+    The profiler is only used by the renders it is given to, the others are not slowed down.
+    """
+
+    def __init__(self, timer=timeit.default_timer):
+        self.timer = timer
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, key, elapsed, size):
+        with self.lock:
+            node = self.stats.get(key)
+            if node is None:
+                node = self.stats[key] = ProfiledNode(*key)
+            node.calls += 1
+            node.time += elapsed
+            node.chars += size
+
+    def nodes(self, key='time'):
+        """ Return the ProfiledNode recorded, the most time consuming first, or sorted by position. """
+        nodes = list(self.stats.values())
+        if key == 'position':
+            return sorted(nodes, key=lambda node: (str(node.template), node.position))
+        return sorted(nodes, key=lambda node: getattr(node, key), reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.stats.clear()
+
+    def report(self, limit=None):
+        """ Return a text report of the most time consuming nodes, the hot spots of the template. """
+        lines = ['%8s %11s %14s %10s  %s' % ('calls', 'time (s)', 'per call (s)', 'chars', 'node')]
+        for node in self.nodes()[:limit]:
+            where = '%s:%s' % (node.template or '<template>', '?' if node.position is None else node.position)
+            lines.append('%8d %11.6f %14.9f %10d  %s %s' % (node.calls, node.time, node.time / node.calls, node.chars, where, node.source))
+        return '\n'.join(lines)
+
+
+class BytesRenders(object):
+    """ The functions rendering a template to bytes, by encoding, and the running estimate of the size of its output,
+    see Template.render_bytes. They are built and updated by the renders, apart from the template, which is never modified
+    once built: the lock keeps them consistent when the template is rendered from many threads.
+
+    >>> renders = BytesRenders()
+    >>> renders.record_size(100), renders.record_size(200), renders.output_size
+    (None, None, 125)
+    """
+
+    def __init__(self):
+        self.functions = {}
+        # In bytes, to size the buffer of render_bytes
+        self.output_size = 0
+        self.lock = threading.Lock()
+
+    def function(self, encoding, build):
+        """ Return the function rendering the encoding, built by build the first time. """
+        function = self.functions.get(encoding)
+        if function is None:
+            with self.lock:
+                function = self.functions.get(encoding)
+                if function is None:
+                    function = self.functions[encoding] = build()
+        return function
+
+    def record_size(self, size):
+        with self.lock:
+            # Follows the size of the outputs as it changes, without being thrown off by a single one
+            self.output_size = size if not self.output_size else (3 * self.output_size + size) // 4
 
 
 class Template(object):
-    """ This class is the public API of the template engine. """
+    """ This class is the public API of the template engine.
+
+    By default the parsed template is compiled to a Python function, pass compiled=False to evaluate it with eval_ instead.
+    Both give the same output:
+    >>> data = {"name": "Eva", "age": 23, "apple_count": 5}
+    >>> Template(open('test.tmpl')).render(data) == Template(open('test.tmpl'), compiled=False).render(data)
+    True
+    >>> print(Template(open('test.tmpl')).render(data))
+    Hello Eva, what a fine age, 23, to be baking apple pies
+    <BLANKLINE>
+    You need 7 until you have a round dozen
+    <BLANKLINE>
+
+    The parsed template is optimized, see optimize, unless optimized=False is given:
+    >>> Template(open('son.tmpl'), optimized=False).render() == Template(open('son.tmpl')).render()
+    True
+    """
 
-    def __init__(self, file_):
+    def __init__(self, file_, compiled=True, environment=None, name=None, optimized=True):
+        # Identifies the template in the processes it is sent to, see load_template
+        self.uid = new_template_uid()
         self.file_ = file_
         self.template = file_.read()
+        self.compiled = compiled
+        self.optimized = optimized
+        # How many nodes of the parsed template the optimizer removed
+        self.removed_nodes = 0
+        self.environment = _GLOBAL_ENV['environment'] if environment is None else environment
+        self.name = name
+        self.parent = None
         self.parsed_template = None
+        self.render_function = None
+        # Compiled with instrumentation for a Profiler, on the first profiled render
+        self.profiled_function = None
+        # The templates specialized by specialize, by key
+        self.specializations = LRUCache()
+        # The functions rendering each top level node, see segments
+        self.segment_functions = None
+        # The functions rendering bytes and the size of their output, see render_bytes
+        self.bytes_renders = BytesRenders()
+        # Do all the work now: once built, a template is never modified, and can be rendered from many threads
+        self.parse()
+        if self.compiled:
+            self.compile()
 
     def parse(self):
+        """ Return the parsed template, with its inheritance resolved once and for all.
+
+        >>> print(Environment().get_template('son.tmpl').render())
+        <BLANKLINE>
+        Grandfather says hello!
+        <BLANKLINE>
+        <BLANKLINE>
+        Father says hello!
+        <BLANKLINE>
+        <BLANKLINE>
+        Son says hello!
+        <BLANKLINE>
+        <BLANKLINE>
+        """
         if self.parsed_template is None:
             tokenized = tokenize(self.template)
-            self.parsed_template = parse(tokenized)
+            parsed_template = parse(tokenized, self.name or getattr(self.file_, 'name', None))
+            parent = find_extends(parsed_template)
+            if parent is not None:
+                self.parent = self.environment.get_template(parent)
+                parsed_template = substitute_blocks(self.parent.parse(), find_blocks(parsed_template))
+            if self.optimized:
+                parsed_template, self.removed_nodes = optimize(parsed_template)
+            self.parsed_template = parsed_template
         return self.parsed_template 
 
-    def render(self, data_model=None):
-        if self.parsed_template is None:
-            tokenized = tokenize(self.template)
-            self.parsed_template = parse(tokenized)
-        return eval_(self.parsed_template, data_model)
+    @classmethod
+    def from_artifact(cls, artifact, compiled=True, environment=None, name=None):
+        """ Build the template from a precompiled one, see read_artifact: it is neither tokenized nor parsed,
+        and its code is not generated again. """
+        template = cls.__new__(cls)
+        template.uid = new_template_uid()
+        template.file_ = None
+        # The text is not needed any more
+        template.template = None
+        template.compiled = compiled
+        template.optimized = artifact['optimized']
+        template.removed_nodes = artifact['removed_nodes']
+        template.environment = _GLOBAL_ENV['environment'] if environment is None else environment
+        template.name = name
+        template.parent = None
+        template.parsed_template = artifact['parsed_template']
+        template.render_function = None
+        template.profiled_function = None
+        template.specializations = LRUCache()
+        template.segment_functions = None
+        template.bytes_renders = BytesRenders()
+        if compiled and artifact['code'] is not None:
+            namespace = CodeGenerator().namespace
+            for constant, description in artifact['constants'].items():
+                namespace[constant] = load_constant(description)
+            template.render_function = load_code(marshal.loads(artifact['code']), namespace)
+            template.render_function.constants = artifact['constants']
+        elif compiled:
+            template.compile()
+        return template
+
+    def compile(self):
+        if self.render_function is None:
+            self.render_function = compile_(self.parse())
+        return self.render_function
+
+    def compile_profiled(self):
+        if self.profiled_function is None:
+            self.profiled_function = compile_(self.parse(), profiling=True)
+        return self.profiled_function
+
+    def compile_bytes(self, encoding):
+        return self.bytes_renders.function(encoding, lambda: compile_(self.parse(), encoding=encoding))
+
+    def render(self, data_model=None, profiler=None):
+        """ Render the template. Given a Profiler, record what each statement and expression costs, see Profiler.
+        Profiled renders use a separately compiled function, even if the template is not compiled.
+        """
+        if profiler is not None:
+            return self.compile_profiled()(data_model, profiler)
+        if not self.compiled:
+            return eval_(self.parse(), data_model)
+        return self.compile()(data_model)
+
+    def generate(self, data_model=None, profiler=None):
+        """ Yield the rendered template chunk by chunk, as it is produced.
+
+        >>> chunks = Template(open('test.tmpl')).generate({"name": "Eva", "age": 23, "apple_count": 5})
+        >>> next(chunks)
+        'Hello '
+        >>> next(chunks)
+        'Eva'
+        """
+        if profiler is not None:
+            return self.compile_profiled().generate(data_model, profiler)
+        if not self.compiled:
+            return generate_(self.parse(), data_model)
+        return self.compile().generate(data_model)
+
+    def specialize(self, static_data, key=None):
+        """ Return a template specialized for the static data, the part of the data model which is the same for many
+        renders, like the locale or the feature flags of a tenant: it is rendered with the rest of the data model only.
+        See specialize for what is evaluated beforehand.
+        Given a key identifying the static data, like the name of the tenant, the specialized template is cached.
+
+        >>> template = Template(open('test.tmpl'))
+        >>> specialized = template.specialize({"age": 23, "apple_count": 5}, key="tenant")
+        >>> specialized.render({"name": "Eva"}) == template.render({"name": "Eva", "age": 23, "apple_count": 5})
+        True
+        >>> template.specialize({"age": 23, "apple_count": 5}, key="tenant") is specialized
+        True
+        """
+        if key is not None:
+            specialized = self.specializations.get(key)
+            if specialized is not None:
+                return specialized
+        specialized = self.__class__.__new__(self.__class__)
+        specialized.__dict__.update(self.__dict__)
+        specialized.uid = new_template_uid()
+        parsed_template = specialize(self.parse(), static_data)
+        if self.optimized:
+            parsed_template, specialized.removed_nodes = optimize(parsed_template)
+        specialized.parsed_template = parsed_template
+        specialized.render_function = None
+        specialized.profiled_function = None
+        specialized.specializations = LRUCache()
+        specialized.segment_functions = None
+        specialized.bytes_renders = BytesRenders()
+        if specialized.compiled:
+            specialized.compile()
+        if key is not None:
+            self.specializations.set(key, specialized)
+        return specialized
+
+    def segments(self):
+        """ Return the names and the rendering functions of the top level nodes of the parsed template, see IncrementalRender.
+        A block is named after its name, any other node is named None. """
+        if self.segment_functions is None:
+            segment_functions = []
+            for node in self.parse():
+                name = node[1] if isinstance(node, tuple) and node[0] == 'block' else None
+                if self.compiled:
+                    function = compile_([node])
+                else:
+                    function = functools.partial(eval_, [node])
+                segment_functions.append((name, function))
+            self.segment_functions = segment_functions
+        return self.segment_functions
+
+    def render_parallel(self, data_model=None, executor=None):
+        """ Render the template on the executor, a process pool, for very large templates made of independent sections:
+        each top level statement, like a block, is rendered by one of its processes, see segments. The output is the same as render.
+        Like in render_many, the executor only needs a map method, and is kept by the caller from one render to the next:
+        starting processes costs more than most renders. Each process compiles the template once, see load_template,
+        but the data model is sent with each statement. It pays off only when rendering a statement takes longer than
+        sending the data model: bench.py render-parallel measures it, around 0.04 s per statement for 200000 elements.
+        Without an executor, or with less than two statements to spread, the template is rendered by this process.
+        The statements using the fragment cache are rendered by this process, as the processes do not share it.
+
+        >>> import multiprocessing
+        >>> pool = multiprocessing.Pool(2)
+        >>> template = Template(open('son.tmpl'))
+        >>> template.render_parallel(executor=pool) == template.render_parallel() == template.render()
+        True
+        >>> pool.close()
+        """
+        if executor is None:
+            return self.render(data_model)
+        nodes = self.parse()
+        # The segments each process renders, as ranges: the runs of constants and expressions go with the next statement
+        tasks, local_tasks, start = [], [], 0
+        for index, node in enumerate(nodes):
+            if isinstance(node, tuple) and is_parsed_token_a_statement(node):
+                (local_tasks if uses_statement(node, 'cache') else tasks).append((start, index + 1))
+                start = index + 1
+        if start < len(nodes):
+            tasks.append((start, len(nodes)))
+        if len(tasks) < 2:
+            return self.render(data_model)
+        results = executor.map(functools.partial(_render_segments, self, data_model), tasks)
+        # Rendered meanwhile, when the map of the executor does not wait for the results, like those of concurrent.futures
+        outputs = dict(zip(local_tasks, [_render_segments(self, data_model, segments) for segments in local_tasks]))
+        outputs.update(zip(tasks, results))
+        return ''.join([outputs[segments] for segments in sorted(outputs)])
+
+    def render_async(self, data_model=None):
+        """ Return a coroutine rendering the template, awaiting the values of the data model which are awaitables,
+        and iterating asynchronously over those which are asynchronous iterables, see template_async. Python 3 only.
+        """
+        return import_async().render_async(self.parse(), data_model)
+
+    def generate_async(self, data_model=None):
+        """ Like render_async, as an asynchronous generator yielding the output chunk by chunk. """
+        return import_async().generate_async(self.parse(), data_model)
+
+    def render_bytes(self, data_model=None, encoding='utf-8'):
+        """ Render the template to bytes, to be sent over the network.
+        The output is written to a single buffer, sized beforehand from the size of the previous outputs.
+
+        >>> template = Template(open('test.tmpl'))
+        >>> data = {"name": "Eva", "age": 23, "apple_count": 5}
+        >>> template.render_bytes(data) == template.render(data).encode('utf-8')
+        True
+        >>> template.bytes_renders.output_size == len(template.render(data))
+        True
+        """
+        buffer = io.BytesIO()
+        estimate = self.bytes_renders.output_size
+        if estimate:
+            # Grow the buffer once, with some room, it is trimmed to the actual size at the end
+            buffer.seek(estimate + estimate // 8)
+            buffer.write(b'\0')
+            buffer.seek(0)
+        if self.compiled:
+            self.compile_bytes(encoding).write(buffer.write, data_model)
+        else:
+            write = buffer.write
+            for chunk in generate_(self.parse(), data_model):
+                write(chunk if type(chunk) == bytes else chunk.encode(encoding))
+        size = buffer.tell()
+        buffer.truncate()
+        self.bytes_renders.record_size(size)
+        return buffer.getvalue()
+
+    def render_to(self, fileobj, data_model=None):
+        """ Write the rendered template to a file-like object, without holding the whole output in memory.
+
+        >>> import sys
+        >>> Template(open('test.tmpl')).render_to(sys.stdout, {"name": "Eva", "age": 23, "apple_count": 5})
+        Hello Eva, what a fine age, 23, to be baking apple pies
+        <BLANKLINE>
+        You need 7 until you have a round dozen
+        """
+        write = fileobj.write
+        for chunk in self.generate(data_model):
+            write(chunk)
+
+    def render_many(self, data_models, executor=None, batch_size=100):
+        """ Render the template for each data model, in order.
+        The renders are spread, in batches, over the executor, a thread or process pool from concurrent.futures.
+
+        >>> template = Template(open('test.tmpl'))
+        >>> outputs = template.render_many([{"name": name, "age": 23, "apple_count": 5} for name in ["Eva", "Billy"]])
+        >>> [output.split(',')[0] for output in outputs]
+        ['Hello Eva', 'Hello Billy']
+
+        The executor only needs a map method, a multiprocessing pool works too:
+        >>> from multiprocessing.pool import ThreadPool
+        >>> pool = ThreadPool(4)
+        >>> template = Template(open('son.tmpl'))
+        >>> data_models = [{"son": "Billy"} for _ in range(10)]
+        >>> template.render_many(data_models, executor=pool, batch_size=3) == [template.render()] * 10
+        True
+        >>> pool.close()
+
+        Templates can be pickled, to be sent to a process pool:
+        >>> import pickle
+        >>> pickle.loads(pickle.dumps(template)).render() == template.render()
+        True
+
+        They are sent with each batch, but a process builds a template only the first time it receives it, see load_template:
+        >>> pickle.loads(pickle.dumps(template)) is pickle.loads(pickle.dumps(template))
+        True
+        """
+        if executor is None:
+            return [self.render(data_model) for data_model in data_models]
+        data_models = list(data_models)
+        batches = [data_models[index:index + batch_size] for index in range(0, len(data_models), batch_size)]
+        outputs = []
+        for batch in executor.map(functools.partial(_render_batch, self), batches):
+            outputs.extend(batch)
+        return outputs
+
+    def __getstate__(self):
+        # Neither the file, the environment and its locks, nor the generated functions can be pickled, for process pools.
+        state = dict(self.__dict__)
+        state.update(file_=None, environment=None, parent=None, render_function=None, profiled_function=None, specializations=None,
+                     segment_functions=None, bytes_renders=None)
+        return state
+
+    def __reduce__(self):
+        return load_template, (self.__class__, self.uid, self.__getstate__())
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.environment = _GLOBAL_ENV['environment']
+        self.specializations = LRUCache()
+        self.bytes_renders = BytesRenders()
+        if self.compiled:
+            self.compile()
 
     def __str__(self):
         return self.render()
 
 
+class IncrementalRender(object):
+    """ The output of a template kept up to date as its data model changes, re-rendering only what changed.
+
+    The output is made of segments, the output of each top level node of the parsed template, see Template.segments,
+    and of each block nested in their if statements and blocks. Those blocks are cut out of the segment holding them:
+    a marker stands for them in its output. Blocks in for loops and cache statements stay in their segment,
+    as they are rendered many times or not at all.
+    Rendering a segment records the variables it reads, see RecordingMapping: it is rendered again only when one of them changes.
+
+    >>> template = Template(open('test.tmpl'))
+    >>> incremental = IncrementalRender(template, {"name": "Eva", "age": 23, "apple_count": 5})
+    >>> incremental.update({"apple_count": 8})
+    [(5, None, '4')]
+    >>> incremental.render() == template.render({"name": "Eva", "age": 23, "apple_count": 8})
+    True
+
+    Only that segment was rendered again, after the 7 of the first render:
+    >>> sorted(incremental.dependencies[5]), incremental.renders
+    (['apple_count'], 8)
+
+    A block nested in an if statement is rendered again on its own, its segments come after the top level ones:
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> with open(os.path.join(directory, 'page.tmpl'), 'w') as f:
+    ...     _ = f.write('{% if show %}<h1>{% block title %}{{ title }}{% endblock %}</h1>{% endif %}')
+    >>> incremental = IncrementalRender(Template(open(os.path.join(directory, 'page.tmpl'))), {"show": True, "title": "Hi"})
+    >>> incremental.update({"title": "Bye"}), incremental.renders
+    ([(1, 'title', 'Bye')], 3)
+    >>> incremental.update({"show": False}), incremental.update({"show": True})
+    ([(0, None, '')], [(0, None, '<h1>Bye</h1>')])
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, template, data_model=None):
+        self.template = template
+        # Updated in place, the data model given is never modified
+        self.data_model = {} if data_model is None else dict(data_model)
+        self.segments = list(template.segments())
+        # By segment, the segments of the blocks cut out of it
+        self.children = [[] for segment in self.segments]
+        for index, node in enumerate(template.parse()):
+            if isinstance(node, tuple) and node[0] == 'block':
+                node = rebuild_statement(node, ['block', node[1], self.extract_blocks(node[2], index)])
+            else:
+                node = self.extract_blocks(node, index)
+            if self.children[index]:
+                self.segments[index] = (self.segments[index][0], self.segment_function([node]))
+        self.outputs = [None] * len(self.segments)
+        # By segment, the names of the variables it read on its last render
+        self.dependencies = [set() for segment in self.segments]
+        # How many segments were rendered
+        self.renders = 0
+        for index in range(len(template.segments())):
+            self.render_segment(index)
+
+    def segment_function(self, parsed_template):
+        if self.template.compiled:
+            return compile_(parsed_template)
+        return functools.partial(eval_, parsed_template)
+
+    def extract_blocks(self, elem, parent):
+        """ Return the parsed token with the blocks of its if statements and blocks replaced by markers,
+        added as segments, children of the parent segment. """
+        if type(elem) == list:
+            return [self.extract_blocks(sub_elem, parent) for sub_elem in elem]
+        if not (isinstance(elem, tuple) and is_parsed_token_a_statement(elem)):
+            return elem
+        if elem[0] == 'if':
+            return rebuild_statement(elem, ['if', elem[1], self.extract_blocks(elem[2], parent), self.extract_blocks(elem[3], parent)])
+        if elem[0] == 'block':
+            index = len(self.segments)
+            self.segments.append(None)
+            self.children.append([])
+            self.children[parent].append(index)
+            self.segments[index] = (elem[1], self.segment_function([self.extract_blocks(elem[2], index)]))
+            return self.marker(index)
+        return elem
+
+    def marker(self, index):
+        # Text never holds NUL characters
+        return '\0%d\0' % index
+
+    def render_segment(self, index):
+        """ Render a segment again, return whether its output changed.
+        The blocks cut out of it are rendered if they appear in its output for the first time. """
+        data_model = RecordingMapping(self.data_model)
+        output = self.segments[index][1](data_model)
+        self.dependencies[index] = data_model.names
+        self.renders += 1
+        for child in self.children[index]:
+            if self.marker(child) not in output:
+                self.outputs[child], self.dependencies[child] = None, set()
+            elif self.outputs[child] is None:
+                self.render_segment(child)
+        if output == self.outputs[index]:
+            return False
+        self.outputs[index] = output
+        return True
+
+    def expand(self, index):
+        """ Return the output of a segment, with the output of the blocks cut out of it. """
+        output = self.outputs[index]
+        for child in self.children[index]:
+            if self.marker(child) in output:
+                output = output.replace(self.marker(child), self.expand(child))
+        return output
+
+    def update(self, changed_data):
+        """ Update the variables of changed_data in the data model, and render again the segments reading any of them.
+        Return the segments whose output changed, as (index, name, output) tuples, in order. """
+        self.data_model.update(changed_data)
+        changed_names = set(changed_data)
+        changed = []
+        for index, names in enumerate(self.dependencies):
+            if not names.isdisjoint(changed_names) and self.render_segment(index):
+                changed.append((index, self.segments[index][0], self.expand(index)))
+        return changed
+
+    def render(self):
+        """ Return the whole output. """
+        return ''.join([self.expand(index) for index in range(len(self.template.segments()))])
+
+
+_TEMPLATE_UIDS = itertools.count()
+
+def new_template_uid():
+    # Unique across processes, templates can be built by forked processes
+    return (os.getpid(), next(_TEMPLATE_UIDS))
+
+def load_template(cls, uid, state):
+    """ Unpickle a template. A template received again is not built and compiled again, the first one received is reused. """
+    template = _RECEIVED_TEMPLATES.get(uid)
+    if template is None:
+        template = cls.__new__(cls)
+        template.__setstate__(state)
+        _RECEIVED_TEMPLATES.set(uid, template)
+    return template
+
+def import_async():
+    """ Return the template_async module, imported on first use: it is Python 3 only, it cannot even be compiled by Python 2. """
+    if str is bytes:
+        raise NotImplementedError("Asynchronous rendering needs Python 3")
+    import template_async
+    return template_async
+
+def _render_batch(template, data_models):
+    return [template.render(data_model) for data_model in data_models]
+
+def _render_segments(template, data_model, segments):
+    start, stop = segments
+    return ''.join([function(data_model) for name, function in template.segments()[start:stop]])
+
+def uses_statement(parsed_template, statement):
+    """ Does the parsed template hold the statement, in any body ?
+
+    >>> uses_statement(['Hi', ('if', ('age', '>', 18), ('cache', (('name',), None), ('name',)), '')], 'cache')
+    True
+    """
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            if uses_statement(elem, statement):
+                return True
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            if elem[0] == statement:
+                return True
+            if any(uses_statement(elem[index], statement) for index in _GLOBAL_ENV['bodies'].get(elem[0], ())):
+                return True
+    return False
+
+
+class LRUCache(object):
+    """ A mapping holding at most max_size entries, the least recently used one is evicted first.
+    Counts its hits and misses, so its size can be tuned.
+
+    >>> cache = LRUCache(max_size=2)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is None
+    True
+    >>> sorted(cache.keys())
+    ['a', 'c']
+    >>> cache.hits, cache.misses
+    (1, 1)
+
+    Entries can expire, after ttl seconds of the clock:
+    >>> now = [0]
+    >>> cache = LRUCache(clock=lambda: now[0])
+    >>> cache.set('a', 1, ttl=60)
+    >>> now[0] = 59
+    >>> cache.get('a')
+    1
+    >>> now[0] = 60
+    >>> cache.get('a') is None, 'a' in cache
+    (True, False)
+    """
+
+    def __init__(self, max_size=100, clock=time.time):
+        self.max_size = max_size
+        # By key, the value and the time it expires at, or None
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, expires = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= self.clock():
+                self.misses += 1
+                return default
+            # Move it to the end, as the most recently used
+            self.entries[key] = value, expires
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else self.clock() + ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value, expires
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def resize(self, max_size):
+        """ Change the maximum number of entries, evicting the least recently used ones beyond it. """
+        with self.lock:
+            self.max_size = max_size
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def keys(self):
+        return list(self.entries.keys())
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and (entry[1] is None or entry[1] > self.clock())
+
+# The output of the cache statements, see eval_cache_statement. Any object with the get and set methods of LRUCache can replace it.
+_GLOBAL_ENV['fragment_cache'] = LRUCache(max_size=1000)
+
+# The templates unpickled by this process, by uid, see load_template
+_RECEIVED_TEMPLATES = LRUCache(max_size=100)
+
+
+class TemplateNotFound(IOError):
+    """ Raised when a template name cannot be found in the search path of the environment. """
+
+
+# Precompiled templates are saved next to their template file, with this suffix appended
+ARTIFACT_SUFFIX = 'c'
+ARTIFACT_MAGIC = b'MINITEMPLATE'
+# Bump it when the parsed templates or the generated code change, so precompiled templates are built again
+ARTIFACT_VERSION = 3
+
+def file_hash(path):
+    # Imported on first use, only precompiled templates need it
+    import hashlib
+    with open(path, 'rb') as file_:
+        return hashlib.sha1(file_.read()).hexdigest()
+
+def dump_artifact(template, file_):
+    """ Write a template loaded by an Environment to a binary file, precompiled: its parsed template,
+    and the code compiled from it if any, with the hashes of the template files it was built from.
+    """
+    sources = [(name, file_hash(path)) for name, (path, mtime) in zip(template.source_names, template.sources)]
+    artifact = {
+        'version': ARTIFACT_VERSION,
+        # The format of marshaled code changes with the version of Python
+        'python': tuple(sys.version_info[:2]),
+        'optimized': template.optimized,
+        'sources': sources,
+        'parsed_template': template.parse(),
+        'removed_nodes': template.removed_nodes,
+        'code': None,
+        'constants': None,
+    }
+    if template.render_function is not None:
+        artifact['code'] = marshal.dumps(template.render_function.code)
+        artifact['constants'] = template.render_function.constants
+    file_.write(ARTIFACT_MAGIC)
+    file_.write(zlib.compress(pickle.dumps(artifact, pickle.HIGHEST_PROTOCOL)))
+
+def read_artifact(file_):
+    """ Return the precompiled template read from a binary file, or None if it was written by another version
+    of the engine or of Python. Like any pickle, only read files you wrote.
+    """
+    if file_.read(len(ARTIFACT_MAGIC)) != ARTIFACT_MAGIC:
+        return None
+    try:
+        artifact = pickle.loads(zlib.decompress(file_.read()))
+    except Exception:
+        # Truncated, or referring to names this version does not have
+        return None
+    if artifact.get('version') != ARTIFACT_VERSION or artifact.get('python') != tuple(sys.version_info[:2]):
+        return None
+    return artifact
+
+
+class Environment(object):
+    """ Loads templates by name from a search path, and keeps them parsed and compiled in a LRU cache.
+    Once cached, getting a template again does no file I/O, except checking its modification time if auto_reload is set.
+
+    >>> environment = Environment(['.'], cache_size=2)
+    >>> template = environment.get_template('test.tmpl')
+    >>> environment.get_template('test.tmpl') is template
+    True
+    >>> environment.cache.hits, environment.cache.misses
+    (1, 1)
+    >>> try:
+    ...     environment.get_template('missing.tmpl')
+    ... except TemplateNotFound as e:
+    ...     print(e)
+    missing.tmpl not found in ['.']
+
+    With auto_reload, a template modified on disk is loaded again:
+    >>> import tempfile, shutil
+    >>> directory = tempfile.mkdtemp()
+    >>> with open(os.path.join(directory, 'hello.tmpl'), 'w') as f:
+    ...     _ = f.write('Hello {{ name }}!')
+    >>> environment = Environment([directory], auto_reload=True)
+    >>> environment.get_template('hello.tmpl').render({'name': 'Eva'})
+    'Hello Eva!'
+    >>> with open(os.path.join(directory, 'hello.tmpl'), 'w') as f:
+    ...     _ = f.write('Goodbye {{ name }}!')
+    >>> os.utime(os.path.join(directory, 'hello.tmpl'), (0, 0))
+    >>> environment.get_template('hello.tmpl').render({'name': 'Eva'})
+    'Goodbye Eva!'
+
+    So is a template whose parent was modified:
+    >>> with open(os.path.join(directory, 'child.tmpl'), 'w') as f:
+    ...     _ = f.write('{% extends hello.tmpl %}')
+    >>> environment.get_template('child.tmpl').render({'name': 'Eva'})
+    'Goodbye Eva!'
+    >>> with open(os.path.join(directory, 'hello.tmpl'), 'w') as f:
+    ...     _ = f.write('Hello again {{ name }}!')
+    >>> os.utime(os.path.join(directory, 'hello.tmpl'), (1, 1))
+    >>> environment.get_template('child.tmpl').render({'name': 'Eva'})
+    'Hello again Eva!'
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, search_path=None, cache_size=100, auto_reload=False, compiled=True, optimized=True, precompiled=False):
+        self.search_path = ['.'] if search_path is None else list(search_path)
+        self.cache = LRUCache(cache_size)
+        self.auto_reload = auto_reload
+        self.compiled = compiled
+        self.optimized = optimized
+        # Load templates from their precompiled files, building those missing or stale, see precompile.py
+        self.precompiled = precompiled
+
+    def resolve(self, name):
+        """ Return the path of the template file, the first found in the search path. """
+        for directory in self.search_path:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                return path
+        raise TemplateNotFound("%s not found in %s" % (name, self.search_path))
+
+    def load(self, name, path):
+        if self.precompiled:
+            template = self.load_artifact(name, path)
+            if template is not None:
+                return template
+        template = self.build(name, path)
+        if self.precompiled:
+            self.save_artifact(template, path)
+        return template
+
+    def build(self, name, path):
+        """ Load the template from its file, ignoring any precompiled file. """
+        mtime = os.path.getmtime(path)
+        with open(path, 'r') as file_:
+            template = Template(file_, compiled=self.compiled, environment=self, name=name, optimized=self.optimized)
+        # Do all the work now, rendering will not have to
+        if self.compiled:
+            template.compile()
+        else:
+            template.parse()
+        # The files the template was built from, with their name and modification time
+        template.source_names = [name]
+        template.sources = [(path, mtime)]
+        if template.parent is not None:
+            template.source_names.extend(template.parent.source_names)
+            template.sources.extend(template.parent.sources)
+        return template
+
+    def load_artifact(self, name, path):
+        """ Return the template loaded from its precompiled file, or None if there is none, or if it is stale:
+        one of the template files it was built from changed since.
+
+        >>> import tempfile, shutil
+        >>> directory = tempfile.mkdtemp()
+        >>> for file_name in ['base.tmpl', 'son.tmpl', 'father.tmpl', 'grandfather.tmpl']:
+        ...     _ = shutil.copy(file_name, directory)
+        >>> environment = Environment([directory], precompiled=True)
+        >>> environment.get_template('son.tmpl').render() == Environment().get_template('son.tmpl').render()
+        True
+        >>> sorted(file_name for file_name in os.listdir(directory) if file_name.endswith(ARTIFACT_SUFFIX))
+        ['father.tmplc', 'grandfather.tmplc', 'son.tmplc']
+        >>> template = environment.load_artifact('son.tmpl', os.path.join(directory, 'son.tmpl'))
+        >>> template.template is None, template.render() == Environment().get_template('son.tmpl').render()
+        (True, True)
+
+        A precompiled template is stale when any template it inherits from changes:
+        >>> with open(os.path.join(directory, 'grandfather.tmpl'), 'a') as f:
+        ...     _ = f.write('Bye!')
+        >>> environment.load_artifact('son.tmpl', os.path.join(directory, 'son.tmpl')) is None
+        True
+        >>> Environment([directory], precompiled=True).get_template('son.tmpl').render().strip()[-4:]
+        'Bye!'
+        >>> environment.load_artifact('son.tmpl', os.path.join(directory, 'son.tmpl')) is None
+        False
+        >>> shutil.rmtree(directory)
+        """
+        try:
+            with open(path + ARTIFACT_SUFFIX, 'rb') as file_:
+                artifact = read_artifact(file_)
+        except (IOError, OSError):
+            return None
+        if artifact is None or artifact['optimized'] != self.optimized:
+            return None
+        source_names, sources = [], []
+        for source_name, digest in artifact['sources']:
+            try:
+                source_path = self.resolve(source_name)
+            except TemplateNotFound:
+                return None
+            mtime = os.path.getmtime(source_path)
+            if file_hash(source_path) != digest:
+                return None
+            source_names.append(source_name)
+            sources.append((source_path, mtime))
+        template = Template.from_artifact(artifact, compiled=self.compiled, environment=self, name=name)
+        template.source_names = source_names
+        template.sources = sources
+        return template
+
+    def save_artifact(self, template, path):
+        """ Write the precompiled template next to its file. Return False if it cannot be written. """
+        # Written under another name first, so other processes never read half a file
+        temporary_path = '%s%s.%d' % (path, ARTIFACT_SUFFIX, os.getpid())
+        try:
+            with open(temporary_path, 'wb') as file_:
+                dump_artifact(template, file_)
+            os.rename(temporary_path, path + ARTIFACT_SUFFIX)
+        except (IOError, OSError):
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            return False
+        return True
+
+    def list_templates(self, extension='.tmpl'):
+        """ Return the names of the templates of the search path, those of its directories and their subdirectories.
+
+        >>> sorted(Environment().list_templates())
+        ['base.tmpl', 'father.tmpl', 'grandfather.tmpl', 'son.tmpl', 'test.tmpl']
+        """
+        names, seen = [], set()
+        for directory in self.search_path:
+            for root, directories, file_names in os.walk(directory):
+                directories.sort()
+                for file_name in sorted(file_names):
+                    name = os.path.relpath(os.path.join(root, file_name), directory)
+                    # A name found first in the search path hides the same name in the next directories
+                    if file_name.endswith(extension) and name not in seen:
+                        names.append(name)
+                        seen.add(name)
+        return names
+
+    def warmup(self, names=None, extension='.tmpl', threads=None, pause_gc=False, grow_cache=False):
+        """ Load the templates on a pool of threads, so they are cached before they are first rendered.
+        The templates are those named, or all those of the search path with the extension. threads defaults to the number of CPUs.
+        Return the time spent loading each template, by name. Raise on the first one which cannot be loaded.
+        Nothing is evicted from the cache while loading. Afterwards the cache keeps its size, and the templates loaded last,
+        unless grow_cache is given: it then grows, if needed, to hold them all, with the templates they extend.
+
+        Loading many templates makes many objects, which all stay alive: collecting garbage meanwhile is wasted time.
+        With pause_gc, the garbage collector is disabled until the warmup is done. It is disabled for the whole process:
+        only use it at startup, while no other thread is working.
+
+        >>> environment = Environment(cache_size=2)
+        >>> sorted(environment.warmup())
+        ['base.tmpl', 'father.tmpl', 'grandfather.tmpl', 'son.tmpl', 'test.tmpl']
+        >>> environment.cache.max_size, len(environment.cache)
+        (2, 2)
+        >>> environment = Environment(cache_size=2)
+        >>> _ = environment.warmup(grow_cache=True)
+        >>> environment.cache.max_size, environment.cache.misses
+        (5, 5)
+        >>> _ = [environment.get_template(name) for name in environment.list_templates()]
+        >>> environment.cache.misses
+        5
+
+        >>> import tempfile, shutil
+        >>> directory = tempfile.mkdtemp()
+        >>> with open(os.path.join(directory, 'broken.tmpl'), 'w') as f:
+        ...     _ = f.write('{% if age > 18 %}adult')
+        >>> try:
+        ...     Environment([directory]).warmup()
+        ... except TemplateSyntaxError as e:
+        ...     print(e)
+        Cannot load broken.tmpl: Unclosed {% if %} opened at token 0
+        >>> shutil.rmtree(directory)
+        """
+        # Imported on first use, it is slow to import
+        from multiprocessing.pool import ThreadPool
+        names = self.list_templates(extension) if names is None else list(names)
+        collecting = pause_gc and gc.isenabled()
+        if collecting:
+            gc.disable()
+        # Nothing is evicted while loading, the templates extended are not known in advance
+        max_size = self.cache.max_size
+        self.cache.resize(float('inf'))
+        pool = ThreadPool(threads)
+        try:
+            times = {}
+            # Templates come as they are loaded, so an error comes as soon as possible
+            for name, seconds in pool.imap_unordered(self.timed_load, names):
+                times[name] = seconds
+        finally:
+            pool.terminate()
+            self.cache.resize(max(max_size, len(self.cache)) if grow_cache else max_size)
+            if collecting:
+                gc.enable()
+        return times
+
+    def timed_load(self, name):
+        """ Get the template, return its name and how long it took. """
+        start = timeit.default_timer()
+        try:
+            self.get_template(name)
+        except TemplateSyntaxError as error:
+            raise TemplateSyntaxError("Cannot load %s: %s" % (name, error), error.position)
+        except ValueError as error:
+            raise TemplateSyntaxError("Cannot load %s: %s" % (name, error))
+        return name, timeit.default_timer() - start
+
+    def is_up_to_date(self, template):
+        return all(os.path.getmtime(path) == mtime for path, mtime in template.sources)
+
+    def get_template(self, name):
+        template = self.cache.get(name)
+        if template is not None and (not self.auto_reload or self.is_up_to_date(template)):
+            return template
+        template = self.load(name, self.resolve(name))
+        self.cache.set(name, template)
+        return template
+
+# Templates loaded by extends come from this environment, searching the current directory
+_GLOBAL_ENV['environment'] = Environment()
+
+
 if __name__ == "__main__":
     """ DOCTEST FTW """
     import doctest
@@ -0,0 +1,211 @@
+"""
+Asynchronous rendering, for data models whose values come from asynchronous calls, like database queries. Python 3 only.
+
+The values of the data model can be awaitables: those the template reads whatever the data, see eager_variables,
+are started as soon as the render starts, so they run concurrently with each other and with the render.
+The others, read in a branch or a loop body, are started when first used. Each is awaited when it is first used.
+A for loop can iterate over an asynchronous iterable.
+
+The parsed template is evaluated by an asynchronous counterpart of generate_, see Template.render_async.
+"""
+
+import asyncio
+import inspect
+
+from template import (_GLOBAL_ENV, _MISSING, fragment_key, loop_fields, iter_columns, Context, Expression, wrap_body, eval_statement, resolve_inheritance,
+                      is_expression, is_parsed_token_a_statement)
+
+
+def eager_variables(parsed_template):
+    """ Return the set of the variables the parsed template reads on every render: not those read only in the branches
+    of if statements, in the bodies of for loops or of cache statements, or by the other statements.
+
+    >>> sorted(eager_variables(['Hi ', ('name',), ('for', ['friend', 'in', 'friends'], [('friend',), ('age',)]), ('if', ('adult',), ('beer',), ('juice',))]))
+    ['adult', 'friends', 'name']
+    """
+    variables = set()
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            variables |= eager_variables(elem)
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            if elem[0] == 'if':
+                variables |= eager_variables([elem[1]])
+            elif elem[0] == 'for' and len(elem[1]) == 3:
+                variables.add(elem[1][2])
+            elif elem[0] == 'block':
+                variables |= eager_variables(elem[2])
+            elif elem[0] == 'cache':
+                variables |= eager_variables([elem[1][0]])
+        elif is_expression(elem):
+            variables.update((elem if type(elem) == Expression else Expression(elem)).variables)
+    return variables
+
+
+class AsyncDataModel(object):
+    """ The data model of an asynchronous render. Its awaitable values of the given variables are scheduled as tasks on creation,
+    the others when first resolved. Their results are layered over the data model once awaited. """
+
+    def __init__(self, data_model, variables=()):
+        self.data_model = data_model
+        # The results of the awaited values, by name
+        self.values = {}
+        self.tasks = {}
+        for name in variables:
+            self.start(name)
+        self.context = Context(self.values, data_model)
+
+    def start(self, name):
+        """ Schedule the value of the name as a task, if it is an awaitable not scheduled yet. """
+        if name not in self.tasks and name in self.data_model and inspect.isawaitable(self.data_model[name]):
+            self.tasks[name] = asyncio.ensure_future(self.data_model[name])
+
+    async def resolve(self, names):
+        """ Await the values of the names which are still pending, starting them if needed. """
+        for name in names:
+            if name not in self.values:
+                self.start(name)
+                if name in self.tasks:
+                    self.values[name] = await self.tasks[name]
+
+    def cancel(self):
+        """ Cancel the values the render did not need after all. """
+        for task in self.tasks.values():
+            task.cancel()
+
+
+async def evaluate(exp, context, loop_names, data):
+    if type(exp) != Expression:
+        exp = Expression(exp)
+    await data.resolve([name for name in exp.variables if name not in loop_names])
+    return exp.evaluate(context)
+
+
+async def generate_body(parsed_template, context, loop_names, data):
+    """ Yield the output of the parsed template, in the context, where the loop_names are loop variables. """
+    for elem in wrap_body(parsed_template):
+        if type(elem) == list:
+            async for chunk in generate_body(elem, context, loop_names, data):
+                yield chunk
+        elif type(elem) == str or type(elem) == int:
+            yield str(elem)
+        elif isinstance(elem, tuple) and is_parsed_token_a_statement(elem):
+            async for chunk in generate_statement(elem, context, loop_names, data):
+                yield chunk
+        elif is_expression(elem):
+            yield str(await evaluate(elem, context, loop_names, data))
+        else:
+            raise Exception("Cannot evaluate parsed token, unknown type: %s" % str(elem))
+
+
+async def generate_statement(stmt, context, loop_names, data):
+    if stmt[0] == 'if':
+        body = stmt[2] if await evaluate(stmt[1], context, loop_names, data) else stmt[3]
+        async for chunk in generate_body(body, context, loop_names, data):
+            yield chunk
+    elif stmt[0] == 'for':
+        for_ = stmt[1]
+        if len(for_) != 3 or for_[1] != 'in':
+            raise ValueError("Unknown for clause: %s " % str(for_))
+        if for_[2] not in loop_names:
+            await data.resolve([for_[2]])
+        elements = context[for_[2]]
+        if isinstance(elements, dict) and loop_fields(stmt[2], for_[0]):
+            # A dict of columns
+            elements = iter_columns(elements, loop_fields(stmt[2], for_[0]))
+        # The loop variable lives in its own scope, the data model is never modified
+        loop_variables = {}
+        scope, scope_names = Context(loop_variables, context), loop_names | set([for_[0]])
+        if hasattr(elements, '__aiter__'):
+            async for element in elements:
+                loop_variables[for_[0]] = element
+                async for chunk in generate_body(stmt[2], scope, scope_names, data):
+                    yield chunk
+        else:
+            for element in elements:
+                loop_variables[for_[0]] = element
+                async for chunk in generate_body(stmt[2], scope, scope_names, data):
+                    yield chunk
+    elif stmt[0] == 'block':
+        async for chunk in generate_body(stmt[2], context, loop_names, data):
+            yield chunk
+    elif stmt[0] == 'cache':
+        params, body = stmt[1:]
+        key, ttl = params
+        await evaluate(key, context, loop_names, data)
+        cache = _GLOBAL_ENV['fragment_cache']
+        cache_key = fragment_key(params, body, context)
+        output = cache.get(cache_key, _MISSING)
+        if output is _MISSING:
+            output = ''.join([chunk async for chunk in generate_body(body, context, loop_names, data)])
+            cache.set(cache_key, output, ttl)
+        yield output
+    else:
+        # Other statements get the whole data model, their parameters naming variables are awaited first
+        await data.resolve([param for param in stmt[1:] if type(param) == str and param not in loop_names])
+        result = eval_statement(stmt, context)
+        if inspect.isgenerator(result):
+            for chunk in result:
+                yield chunk
+        else:
+            yield str(result)
+
+
+async def generate_async(parsed_template, data_model=None):
+    """ Like generate_, as an asynchronous generator: yield the output chunk by chunk, awaiting the values of the data model.
+
+    >>> async def friends():
+    ...     for friend in ['Billy', 'John']:
+    ...         await asyncio.sleep(0)
+    ...         yield friend
+    >>> async def collect(chunks):
+    ...     return [chunk async for chunk in chunks]
+    >>> parsed = [('for', ['friend', 'in', 'friends'], [('friend',), ', ']), 'and ', ('len', 'others')]
+    >>> asyncio.run(collect(generate_async(parsed, {'friends': friends(), 'others': asyncio.sleep(0, ['Emily'])})))
+    ['Billy', ', ', 'John', ', ', 'and ', '1']
+    >>> parsed = [('cache', (('"greeting"',), None), ['Hello ', ('name',)])]
+    >>> asyncio.run(collect(generate_async(parsed, {'name': asyncio.sleep(0, 'Eva')})))
+    ['Hello Eva']
+
+    The values of a branch not taken are never started:
+    >>> started = []
+    >>> async def query(name):
+    ...     started.append(name)
+    ...     return name
+    >>> parsed = [('if', ('member',), ('price',), ('discount',))]
+    >>> data_model = {'member': query('member'), 'price': query('price'), 'discount': query('discount')}
+    >>> asyncio.run(collect(generate_async(parsed, data_model)))
+    ['price']
+    >>> started
+    ['member', 'price']
+    >>> data_model['discount'].close()
+    """
+    data_model = {} if data_model is None else data_model
+    data = AsyncDataModel(data_model, eager_variables(parsed_template))
+    try:
+        async for chunk in generate_body(parsed_template, data.context, frozenset(), data):
+            yield chunk
+    finally:
+        data.cancel()
+
+
+async def render_async(parsed_template, data_model=None):
+    """ Like eval_, awaiting the values of the data model. The awaitables run concurrently:
+
+    >>> events = []
+    >>> async def slow(value):
+    ...     events.append(('start', value))
+    ...     await asyncio.sleep(0)
+    ...     events.append(('end', value))
+    ...     return value
+    >>> parsed = ['Hello ', ('name',), ', you are ', ('if', ('age', '>=', 18), 'an adult', 'a child')]
+    >>> asyncio.run(render_async(parsed, {'name': slow('Eva'), 'age': slow(23)}))
+    'Hello Eva, you are an adult'
+    >>> [event for event, value in events]
+    ['start', 'start', 'end', 'end']
+    """
+    return ''.join([chunk async for chunk in generate_async(resolve_inheritance(parsed_template), data_model)])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()